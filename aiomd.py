@@ -0,0 +1,401 @@
+"""
+An asyncio version of the md module.
+
+AsyncMinuteDock offers the same searches as md.MinuteDock, but every
+network operation is a coroutine running on non-blocking sockets, so it
+can be used from inside an event loop without blocking it. The User,
+Contact, Project and Entry classes are shared with the md module; for
+entries obtained through an AsyncMinuteDock, Entry.update returns a
+coroutine which must be awaited.
+
+    md = await AsyncMinuteDock.create()
+    entries = await md.entries_search(date_range=(start, end))
+    entries[0].change_project('SOMEPROJECT')
+    await entries[0].update()
+    await md.close()
+
+This module requires Python 3.6 or greater.
+"""
+
+import asyncio
+import http.client
+import io
+import json
+import time
+import urllib.parse
+
+from md import BaseMinuteDock, RequestEvent, RetryPolicy, TokenBucket, TransferStats, UpdateResult
+
+class AsyncResponse(object):
+    """A fully read response obtained through an AsyncConnectionPool.
+
+    reused is True if the request was sent on an already open connection.
+    Otherwise timings['connect'] is the time taken to open the new
+    connection, including resolving the host and any TLS handshake.
+    """
+
+    def __init__(self, status, reason, headers, body):
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.body = body
+        self.reused = None
+        self.timings = {}
+
+class AsyncConnectionPool(object):
+    """A pool of persistent HTTP/1.1 connections, opened with
+    asyncio.open_connection, to the host in url_base. At most maxsize idle
+    connections are retained.
+
+    This is the default transport of AsyncMinuteDock. Any object with the
+    same interface can be given as AsyncMinuteDock(transport=...) instead:
+    a url_base attribute, a coroutine request(method, url, body, headers)
+    returning an AsyncResponse, and a coroutine close()."""
+
+    def __init__(self, url_base, ssl_context=None, maxsize=8):
+        parts = urllib.parse.urlsplit(url_base)
+        self.url_base = url_base.rstrip('/')
+        self.scheme = parts.scheme
+        self.netloc = parts.netloc
+        self.host = parts.hostname
+        self.port = parts.port or (443 if self.scheme == 'https' else 80)
+        self.path = parts.path.rstrip('/')
+        self.ssl_context = ssl_context if self.scheme == 'https' else None
+        self.maxsize = maxsize
+        self._idle = []
+
+    async def _get(self):
+        """Return a ((reader, writer), reused) tuple."""
+        if self._idle:
+            return self._idle.pop(), True
+        conn = await asyncio.open_connection(self.host, self.port, ssl=self.ssl_context)
+        return conn, False
+
+    def _put(self, conn):
+        if len(self._idle) < self.maxsize:
+            self._idle.append(conn)
+        else:
+            conn[1].close()
+
+    async def request(self, method, url, body=None, headers=None):
+        """Send a request and return an AsyncResponse. url is relative
+        to url_base. If an idle connection turns out to have been dropped
+        by the server the request is transparently resent on a new one."""
+        headers = dict(headers) if headers else {}
+        headers.setdefault('Accept-Encoding', 'identity')
+        lines = ['%s %s HTTP/1.1' % (method, self.path + url),
+                 'Host: %s' % self.netloc]
+        if body is not None:
+            lines.append('Content-Length: %d' % len(body))
+        for item in headers.items():
+            lines.append('%s: %s' % item)
+        request = ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + (body or b'')
+
+        while True:
+            start = time.perf_counter()
+            conn, reused = await self._get()
+            connect_time = time.perf_counter() - start
+            (reader, writer) = conn
+            try:
+                writer.write(request)
+                await writer.drain()
+                status_line = await reader.readline()
+                if not status_line:
+                    raise ConnectionResetError("Connection closed by server")
+            except ConnectionError:
+                writer.close()
+                if reused:
+                    continue
+                raise
+            except:
+                writer.close()
+                raise
+            break
+
+        try:
+            (response, keep_alive) = await self._read_response(reader, status_line, method)
+        except:
+            writer.close()
+            raise
+        if keep_alive:
+            self._put(conn)
+        else:
+            writer.close()
+        response.reused = reused
+        if not reused:
+            response.timings['connect'] = connect_time
+        return response
+
+    async def _read_headers(self, reader):
+        header_lines = []
+        while True:
+            line = await reader.readline()
+            header_lines.append(line)
+            if line in (b'\r\n', b'\n', b''):
+                break
+        return http.client.parse_headers(io.BytesIO(b''.join(header_lines)))
+
+    async def _read_response(self, reader, status_line, method='GET'):
+        """Read the rest of a response to a method request. Returns a
+        (response, keep_alive) tuple."""
+        while True:
+            (version, status, reason) = (status_line.decode('latin-1').rstrip('\r\n').split(' ', 2) + [''])[:3]
+            status = int(status)
+            headers = await self._read_headers(reader)
+            if not 100 <= status < 200:
+                break
+            # Skip interim responses such as '100 Continue'
+            status_line = await reader.readline()
+
+        keep_alive = version == 'HTTP/1.1'
+        if headers.get('Connection', '').lower() == 'close':
+            keep_alive = False
+
+        if method == 'HEAD' or status in (204, 304):
+            body = b''
+        elif headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int((await reader.readline()).split(b';')[0], 16)
+                if size == 0:
+                    # Skip any trailers
+                    while (await reader.readline()) not in (b'\r\n', b''):
+                        pass
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readexactly(2)
+            body = b''.join(chunks)
+        elif 'Content-Length' in headers:
+            body = await reader.readexactly(int(headers['Content-Length']))
+        else:
+            # The body is delimited by the server closing the connection
+            # (RFC 7230 3.3.3), so the connection can't be reused.
+            body = await reader.read()
+            keep_alive = False
+
+        return (AsyncResponse(status, reason, headers, body), keep_alive)
+
+    async def close(self):
+        """Close all idle connections."""
+        idle, self._idle = self._idle, []
+        for (reader, writer) in idle:
+            writer.close()
+
+class AsyncMinuteDock(BaseMinuteDock):
+    """An asyncio version of md.MinuteDock. Construction does no I/O; the
+    users, contacts and projects (and their lookup dictionaries, as on
+    md.MinuteDock) are available once 'load' has been awaited. The 'create'
+    class method constructs and loads in one step.
+    """
+
+    def __init__(self, api_key=None, url_base=None, pool_size=8, cache=None, query_cache=None,
+                 partial_updates=False, retry=None, compression=True, transport=None, observers=None):
+        """Create an AsyncMinuteDock object. Arguments are as for md.MinuteDock,
+        except that a transport must provide the AsyncConnectionPool interface."""
+        self.api_key = self._read_api_key(api_key)
+
+        if transport is not None:
+            self.pool = transport
+        else:
+            if url_base is None:
+                url_base = self.URL_BASE
+            ssl_context = self._ssl_context() if urllib.parse.urlsplit(url_base).scheme == 'https' else None
+            self.pool = AsyncConnectionPool(url_base, ssl_context, maxsize=pool_size)
+        self.cache = cache
+        self.query_cache = query_cache
+        self.partial_updates = partial_updates
+        self.retry = retry if retry is not None else RetryPolicy()
+        self.compression = compression
+        self.stats = TransferStats()
+        self.observers = list(observers) if observers else []
+
+    @classmethod
+    async def create(cls, *args, refresh=False, **kwargs):
+        """Create an AsyncMinuteDock object and load its reference data."""
+        md = cls(*args, **kwargs)
+        await md.load(refresh)
+        return md
+
+    async def load(self, refresh=False):
+        """Load the users, contacts and projects, from the cache if there is a
+        fresh copy and refresh is False, otherwise by fetching them concurrently."""
+        cached = None
+        if self.cache is not None and not refresh:
+            cached = self.cache.load(self.api_key, self.pool.url_base)
+
+        if cached is None:
+            cached = await asyncio.gather(self._do_get('users.json'),
+                                          self._do_get('contacts.json'),
+                                          self._do_get('projects.json'))
+            if self.cache is not None:
+                self.cache.store(self.api_key, self.pool.url_base, *cached)
+
+        self._set_reference_data(*cached)
+
+    async def close(self):
+        """Close any idle connections held by the connection pool."""
+        await self.pool.close()
+
+    async def _request(self, method, req, args=None, body=None, headers=None):
+        """Internal function to perform a request and return the raw response body.
+        Failed requests are retried as allowed by the retry policy. Raises
+        urllib.error.HTTPError for error responses."""
+        url = self._url(req, args)
+        headers = self._request_headers(headers)
+        attempt = 0
+        while True:
+            await asyncio.sleep(self.retry.reserve())
+            event = RequestEvent(method, req, args, attempt)
+            try:
+                response = await self.pool.request(method, url, body, headers)
+                event.response_received(response)
+                event.bytes_on_wire = len(response.body)
+                response.body = self._decode_body(response.headers, response.body)
+                event.bytes_decoded = len(response.body)
+            except self.retry.RETRY_ERRORS + (asyncio.IncompleteReadError,) as e:
+                self._notify(event, e)
+                delay = self.retry.retry_delay(attempt)
+                if delay is None:
+                    raise
+            except Exception as e:
+                self._notify(event, e)
+                raise
+            else:
+                self._notify(event)
+                if response.status < 400:
+                    return response.body
+                delay = self.retry.retry_delay(attempt, response.status, response.headers)
+                if delay is None:
+                    self._check_response(self.pool.url_base + url, response.status, response.reason,
+                                         response.headers, response.body)
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def _do_get(self, req, args=None):
+        """Internal function to perform 'GET' requests."""
+        data = await self._request('GET', req, args)
+        return json.loads(data.decode())
+
+    async def _do_put(self, req, obj):
+        """Internal function to perform 'PUT' requests."""
+        upload_data = json.dumps(obj).encode()
+        await self._request('PUT', req, body=upload_data, headers={'Content-Type': 'application/json'})
+
+    async def _put_entry(self, entry, force=False):
+        """Internal function to update an entry on the server, if it has changed."""
+        payload = self._entry_payload(entry, force)
+        if payload is None:
+            return
+        await self._do_put('entries/%s.json' % entry.entry_id, payload)
+        self._entry_updated(entry)
+
+    async def _get_page(self, search_dict, offset):
+        """Internal function to fetch the page of entries at offset."""
+        args = dict(search_dict)
+        args['offset'] = str(offset)
+        return await self._do_get('entries.json', args)
+
+    async def _iter_pages(self, search_dict):
+        """Internal asynchronous generator yielding successive non-empty pages of entries."""
+        offset = 0
+        while True:
+            page = await self._get_page(search_dict, offset)
+            if len(page) == 0:
+                break
+            yield page
+            offset += len(page)
+
+    async def _fetch_entries(self, search_dict, workers=1):
+        """Internal function that pages through 'entries.json'. See
+        md.MinuteDock._fetch_entries; with workers greater than one, up to
+        workers page requests run as concurrent tasks."""
+        entries = []
+        offset = 0
+        page = await self._get_page(search_dict, offset)
+
+        if workers > 1 and len(page) > 0:
+            page_size = len(page)
+            pending = [asyncio.ensure_future(self._get_page(search_dict, page_size * (i + 1)))
+                       for i in range(workers)]
+            try:
+                while len(page) == page_size:
+                    entries += page
+                    offset += page_size
+                    page = await pending.pop(0)
+                    pending.append(asyncio.ensure_future(
+                        self._get_page(search_dict, offset + page_size * (len(pending) + 1))))
+            finally:
+                for f in pending:
+                    f.cancel()
+
+        while len(page) > 0:
+            entries += page
+            offset += len(page)
+            page = await self._get_page(search_dict, offset)
+
+        return entries
+
+    async def _fetch_sharded(self, search_dict, date_range, shard, workers=1):
+        """Internal function that fetches each shard of date_range as an
+        independent search, up to workers at a time, and merges the results."""
+        semaphore = asyncio.Semaphore(max(workers, 1))
+
+        async def fetch(shard_dict):
+            async with semaphore:
+                return await self._fetch_entries(shard_dict)
+
+        results = await asyncio.gather(*[fetch(d) for d in self._shard_dicts(search_dict, date_range, shard)])
+        return self._merge_shards(results)
+
+    async def entries_search(self, date_range=None, user_logins=None, contacts=None, projects=None, workers=1,
+                             shard=None, as_table=False):
+        """Search for entries that match the search criteria. Arguments are as
+        for md.MinuteDock.entries_search."""
+        if shard is not None and date_range is None:
+            raise ValueError("A date_range is required for a sharded search")
+
+        search_dict = self._search_dict(date_range, user_logins, contacts, projects)
+
+        entries = None
+        if self.query_cache is not None:
+            entries = self.query_cache.get(self.api_key, self.pool.url_base, search_dict)
+
+        if entries is None:
+            if shard is None:
+                entries = await self._fetch_entries(search_dict, workers)
+            else:
+                entries = await self._fetch_sharded(search_dict, date_range, shard, workers)
+            if self.query_cache is not None:
+                self.query_cache.put(self.api_key, self.pool.url_base, search_dict, entries)
+
+        return self._make_result(entries, projects, as_table)
+
+    async def entries_iter(self, date_range=None, user_logins=None, contacts=None, projects=None):
+        """An asynchronous generator version of entries_search, for use with
+        'async for'. Entry objects are yielded a page at a time as each page
+        arrives. Arguments are as for md.MinuteDock.entries_search."""
+        search_dict = self._search_dict(date_range, user_logins, contacts, projects)
+        async for page in self._iter_pages(search_dict):
+            for e in self._make_entries(page, projects):
+                yield e
+
+    async def update_many(self, entries, workers=4, rate=None):
+        """Update the backend copy of each of entries, with up to workers PUT
+        requests in flight. Arguments and result are as for
+        md.MinuteDock.update_many."""
+        limiter = TokenBucket(rate) if rate else None
+        semaphore = asyncio.Semaphore(max(workers, 1))
+
+        async def update_one(entry):
+            if not entry.is_dirty:
+                return UpdateResult(entry, None)
+            async with semaphore:
+                if limiter is not None:
+                    await asyncio.sleep(limiter.reserve())
+                try:
+                    await entry.update()
+                except Exception as e:
+                    return UpdateResult(entry, e)
+                return UpdateResult(entry, None)
+
+        return await asyncio.gather(*[update_one(e) for e in entries])
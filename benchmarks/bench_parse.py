@@ -0,0 +1,60 @@
+"""
+Microbenchmark of 'logged_at' parsing: the original strptime based code
+against md.parse_logged_at, over synthetic entries.
+
+Usage: python benchmarks/bench_parse.py [-n ENTRIES]
+"""
+import argparse
+import datetime
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from md import Entry, parse_logged_at
+
+OFFSETS = ['+10:00', '+09:30', '+08:00', '+00:00', '-05:00']
+
+def synthetic_entries(n):
+    random.seed(0)
+    start = datetime.datetime(2010, 1, 1)
+    entries = []
+    for i in range(n):
+        logged_at = start + datetime.timedelta(seconds=random.randint(0, 5 * 365 * 86400))
+        entries.append({'id': i, 'user_id': 1, 'contact_id': 1, 'project_id': None, 'duration': 3600,
+                        'description': 'entry %d' % i, 'timer_active': False,
+                        'logged_at': logged_at.strftime('%Y-%m-%dT%H:%M:%S') + random.choice(OFFSETS)})
+    return entries
+
+def strptime_logged_at(date):
+    """The parsing previously done in Entry.__init__."""
+    date = date[:-3] + date[-2:]
+    return datetime.datetime.strptime(date, '%Y-%m-%dT%H:%M:%S%z')
+
+def run(name, func, values):
+    start = time.perf_counter()
+    for v in values:
+        func(v)
+    elapsed = time.perf_counter() - start
+    print("%-18s %8.3fs  %6.2fus/entry" % (name, elapsed, elapsed / len(values) * 1e6))
+    return elapsed
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('-n', type=int, default=1000000, help='number of synthetic entries')
+    args = parser.parse_args()
+
+    entries = synthetic_entries(args.n)
+    values = [e['logged_at'] for e in entries]
+
+    for v in values[:1000]:
+        assert parse_logged_at(v) == strptime_logged_at(v)
+
+    old = run('strptime', strptime_logged_at, values)
+    new = run('parse_logged_at', parse_logged_at, values)
+    print("speedup %.1fx" % (old / new))
+    run('Entry.__init__', lambda raw: Entry(None, raw), entries)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,321 @@
+"""
+Benchmark suite for the hot paths of the md module, run against a fake
+MinuteDock API (mdfake) served from a separate process on a local port.
+
+Benchmarks:
+
+  startup      MinuteDock() construction, loading users, contacts and projects
+  page         a single 'entries.json' page request, at a random offset
+  search       entries_search paginating through every entry of the dataset,
+               with the default serial, streaming path
+  search_concurrent
+               the same with workers=N, fetching pages speculatively ahead
+  parse        Entry.__init__ from raw entry dictionaries
+  str          Entry.__str__ formatting
+  group        report.py style sort, group by user and totals
+  update       Entry.update, one PUT at a time
+  update_many  MinuteDock.update_many with concurrent PUTs
+
+page, search, search_concurrent, parse, str and group run at each
+dataset size. Every
+benchmark runs in a fresh interpreter so its peak RSS (from
+resource.getrusage) is its own. For each one the throughput, latency
+percentiles of a single operation and peak RSS are reported, and can be
+saved as JSON and compared with a previous run to spot regressions:
+
+Usage: python benchmarks/bench_suite.py [--sizes 1000,100000,1000000] [--only NAME,...]
+                                        [--output FILE] [--compare OLD_FILE]
+"""
+import argparse
+import datetime
+import json
+import operator
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+from md import Entry, MinuteDock
+from mdagg import aggregate, group_by
+from mdfake import Dataset, FakeAPI, FakeTransport
+
+API_KEY = 'bench'
+SEED = 0
+UPDATE_SIZE = 1000
+BATCH = 1000
+
+BENCHMARKS = ['startup', 'page', 'search', 'search_concurrent', 'parse', 'str', 'group', 'update',
+              'update_many']
+SIZED = ('page', 'search', 'search_concurrent', 'parse', 'str', 'group')
+
+def percentile(samples, p):
+    """Return the p'th percentile (nearest rank) of samples."""
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, max(0, int(round(p / 100.0 * len(ordered))) - 1))]
+
+def peak_rss_kb():
+    """Return the peak resident set size of this process in KiB, or None."""
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and KiB elsewhere
+    return rss // 1024 if sys.platform == 'darwin' else rss
+
+def measure(op, repeat):
+    """Call op once to warm up, then repeat times, and return the list of
+    durations in seconds of the timed calls."""
+    op()
+    samples = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        op()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+def raw_batches(dataset):
+    """Return a function giving successive batches of raw entries from dataset."""
+    state = {'next': 0}
+    def batch():
+        first = state['next']
+        state['next'] = (first + BATCH) % len(dataset)
+        return [dataset.raw_entry(i % len(dataset)) for i in range(first, first + BATCH)]
+    return batch
+
+def offline_md():
+    """Return a MinuteDock for the default dataset that never touches the network."""
+    return MinuteDock(api_key=API_KEY, transport=FakeTransport(FakeAPI(Dataset(entries=0, seed=SEED))))
+
+# Each benchmark returns a (description of one operation, items per
+# operation, samples) tuple, where samples are the operation durations.
+
+def bench_startup(args):
+    def op():
+        MinuteDock(api_key=API_KEY, url_base=args.url).close()
+    return ('MinuteDock()', 1, measure(op, args.repeat or 50))
+
+def bench_page(args):
+    md = MinuteDock(api_key=API_KEY, url_base=args.url)
+    search_dict = md._search_dict()
+    rng = random.Random(SEED)
+    def op():
+        md._get_page(search_dict, rng.randrange(args.size))
+    return ('one page request', 1, measure(op, args.repeat or 500))
+
+def _bench_search(args, workers):
+    md = MinuteDock(api_key=API_KEY, url_base=args.url)
+    def op():
+        entries = md.entries_search(workers=workers)
+        assert len(entries) == args.size
+    return ('entries_search(workers=%d) of %d entries' % (workers, args.size), args.size,
+            measure(op, args.repeat or max(1, min(10, 100000 // args.size))))
+
+def bench_search(args):
+    return _bench_search(args, 1)
+
+def bench_search_concurrent(args):
+    return _bench_search(args, args.workers)
+
+def bench_parse(args):
+    next_batch = raw_batches(Dataset(entries=args.size, seed=SEED))
+    md = offline_md()
+    [Entry(md, raw) for raw in next_batch()]
+    samples = []
+    for i in range(args.repeat or max(1, args.size // BATCH)):
+        batch = next_batch()
+        start = time.perf_counter()
+        for raw in batch:
+            Entry(md, raw)
+        samples.append(time.perf_counter() - start)
+    return ('Entry() x %d' % BATCH, BATCH, samples)
+
+def bench_str(args):
+    next_batch = raw_batches(Dataset(entries=args.size, seed=SEED))
+    md = offline_md()
+    [str(Entry(md, raw)) for raw in next_batch()]
+    samples = []
+    for i in range(args.repeat or max(1, args.size // BATCH)):
+        entries = [Entry(md, raw) for raw in next_batch()]
+        start = time.perf_counter()
+        for e in entries:
+            str(e)
+        samples.append(time.perf_counter() - start)
+    return ('str(Entry) x %d' % BATCH, BATCH, samples)
+
+def bench_group(args):
+    dataset = Dataset(entries=args.size, seed=SEED)
+    md = offline_md()
+    entries = [Entry(md, dataset.raw_entry(i)) for i in range(len(dataset))]
+    def op():
+        # As in report.py
+        active = [e for e in entries if not e.timer_active]
+        active.sort(key=operator.attrgetter('user_id', 'date'))
+        groups = group_by(active, 'user_id').values()
+        totals = aggregate(active, 'user')
+        assert sum([len(g) for g in groups]) == sum([a.count for a in totals.values()])
+    return ('sort, group and total %d entries' % args.size, args.size, measure(op, args.repeat or 3))
+
+def _changed_entries(md):
+    entries = md.entries_search()[:UPDATE_SIZE]
+    codes = [p.short_code for p in md.projects]
+    for (i, e) in enumerate(entries):
+        e.change_project(codes[i % len(codes)])
+        e.description = 'Benchmark %d' % i
+    return entries
+
+def bench_update(args):
+    md = MinuteDock(api_key=API_KEY, url_base=args.url)
+    entries = _changed_entries(md)
+    samples = []
+    for e in entries:
+        start = time.perf_counter()
+        e.update()
+        samples.append(time.perf_counter() - start)
+    return ('Entry.update', 1, samples)
+
+def bench_update_many(args):
+    md = MinuteDock(api_key=API_KEY, url_base=args.url)
+    def op():
+        for e in entries:
+            e.description += '.'
+        results = md.update_many(entries, workers=args.workers)
+        assert all([r.error is None for r in results])
+    entries = _changed_entries(md)
+    return ('update_many of %d entries' % len(entries), len(entries), measure(op, args.repeat or 3))
+
+def run_child(args):
+    """Run a single benchmark in this process and print its result as JSON."""
+    baseline = peak_rss_kb()
+    (op, items, samples) = globals()['bench_' + args.child](args)
+    seconds = sum(samples)
+    result = {
+        'benchmark': args.child,
+        'size': args.size if args.child in SIZED else None,
+        'op': op,
+        'ops': len(samples),
+        'seconds': seconds,
+        'throughput': items * len(samples) / seconds if seconds else None,
+        'latency': dict([('p%d' % p, percentile(samples, p)) for p in (50, 90, 99)] +
+                        [('min', min(samples)), ('max', max(samples))]),
+        'baseline_rss_kb': baseline,
+        'peak_rss_kb': peak_rss_kb(),
+    }
+    print(json.dumps(result))
+
+def start_server(size, page_size):
+    """Start an mdfake server process for a dataset of size entries.
+    Returns a (process, url_base) tuple."""
+    process = subprocess.Popen([sys.executable, '-u', os.path.join(ROOT, 'mdfake.py'), '--entries', str(size),
+                                '--page-size', str(page_size), '--seed', str(SEED), '--port', '0'],
+                               stdout=subprocess.PIPE, universal_newlines=True)
+    line = process.stdout.readline()
+    if not line:
+        raise Exception("mdfake server failed to start")
+    return (process, line.split()[-1])
+
+def run_benchmark(name, size, url, args):
+    command = [sys.executable, os.path.abspath(__file__), '--child', name, '--size', str(size),
+               '--workers', str(args.workers), '--repeat', str(args.repeat)]
+    if url is not None:
+        command += ['--url', url]
+    output = subprocess.check_output(command, universal_newlines=True)
+    return json.loads(output.strip().splitlines()[-1])
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL, universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def result_key(result):
+    return (result['benchmark'], result['size'])
+
+def print_result(result, old=None):
+    latency = result['latency']
+    line = "%-17s %9s %14.1f/s  p50 %10.3fms  p90 %10.3fms  p99 %10.3fms  rss %8s KiB" % (
+        result['benchmark'], result['size'] or '', result['throughput'],
+        latency['p50'] * 1e3, latency['p90'] * 1e3, latency['p99'] * 1e3, result['peak_rss_kb'])
+    if old is not None:
+        change = result['throughput'] / old['throughput'] - 1
+        line += "  %+6.1f%%%s" % (change * 100, '  REGRESSION' if change < -old['threshold'] else '')
+    print(line)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', default='1000,100000,1000000',
+                        help='comma separated dataset sizes (default: %(default)s)')
+    parser.add_argument('--only', help='comma separated benchmarks to run (default: all)')
+    parser.add_argument('--workers', type=int, default=4, help='workers for search_concurrent and update_many')
+    parser.add_argument('--page-size', type=int, default=50, help='entries per page served')
+    parser.add_argument('--repeat', type=int, default=0, help='operations per benchmark (default: automatic)')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--compare', help='compare throughput with the results in this JSON file')
+    parser.add_argument('--threshold', type=float, default=0.1,
+                        help='flag throughput losses larger than this fraction (default: %(default)s)')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    parser.add_argument('--size', type=int, default=1000, help=argparse.SUPPRESS)
+    parser.add_argument('--url', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(args)
+        return
+
+    names = args.only.split(',') if args.only else BENCHMARKS
+    for name in names:
+        if name not in BENCHMARKS:
+            parser.error("unknown benchmark %r" % name)
+    sizes = [int(s) for s in args.sizes.split(',')]
+
+    old = {}
+    if args.compare:
+        with open(args.compare) as f:
+            for result in json.load(f)['results']:
+                result['threshold'] = args.threshold
+                old[result_key(result)] = result
+
+    # The unsized benchmarks (which update entries) run against their own
+    # small dataset, so they never disturb the sized ones.
+    runs = [(name, size) for size in sizes for name in names if name in SIZED]
+    runs += [(name, UPDATE_SIZE) for name in names if name not in SIZED]
+
+    results = []
+    servers = {}
+    try:
+        for (name, size) in runs:
+            url = None
+            if name not in ('parse', 'str', 'group'):
+                key = (size, name in SIZED)
+                if key not in servers:
+                    servers[key] = start_server(size, args.page_size)
+                url = servers[key][1]
+            result = run_benchmark(name, size, url, args)
+            results.append(result)
+            print_result(result, old.get(result_key(result)))
+            sys.stdout.flush()
+    finally:
+        for (process, url) in servers.values():
+            process.terminate()
+            process.wait()
+
+    if args.output:
+        report = {
+            'meta': {'revision': git_revision(), 'time': datetime.datetime.now().isoformat(),
+                     'python': platform.python_version(), 'platform': platform.platform(),
+                     'sizes': sizes, 'workers': args.workers, 'page_size': args.page_size},
+            'results': results,
+        }
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == "__main__":
+    main()
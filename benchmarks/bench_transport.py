@@ -0,0 +1,82 @@
+"""
+Compare per-request latency of a fresh urllib connection per request
+against the keep-alive ConnectionPool used by MinuteDock.
+
+Both run against a local stand-in server that answers every GET with a
+small JSON page, so the difference is the cost of connection setup.
+
+Usage: python benchmarks/bench_transport.py [-n REQUESTS]
+"""
+import argparse
+import http.server
+import json
+import os
+import socketserver
+import statistics
+import sys
+import threading
+import time
+import urllib.request
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from md import ConnectionPool
+
+PAGE = json.dumps([{'id': i, 'description': 'entry %d' % i} for i in range(50)]).encode()
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(PAGE)))
+        self.end_headers()
+        self.wfile.write(PAGE)
+
+    def log_message(self, *args):
+        pass
+
+class Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+def time_requests(fetch, n):
+    timings = []
+    for i in range(n):
+        start = time.perf_counter()
+        fetch()
+        timings.append(time.perf_counter() - start)
+    return timings
+
+def report(name, timings):
+    print("%-12s mean %8.1fus  median %8.1fus  p95 %8.1fus" %
+          (name, statistics.mean(timings) * 1e6, statistics.median(timings) * 1e6,
+           sorted(timings)[int(len(timings) * 0.95)] * 1e6))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('-n', type=int, default=2000, help='number of requests per run')
+    args = parser.parse_args()
+
+    server = Server(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url_base = 'http://127.0.0.1:%d/api/v1' % server.server_address[1]
+
+    opener = urllib.request.build_opener()
+    def fetch_urllib():
+        opener.open(url_base + '/entries.json?offset=0').read()
+
+    pool = ConnectionPool(url_base)
+    def fetch_pool():
+        response = pool.request('GET', '/entries.json?offset=0')
+        response.read()
+        response.close()
+
+    report('urllib', time_requests(fetch_urllib, args.n))
+    report('pool', time_requests(fetch_pool, args.n))
+
+    pool.close()
+    server.shutdown()
+
+if __name__ == "__main__":
+    main()
@@ -17,9 +17,26 @@ import json
 import os.path
 import ssl
 import sys
+import io
+import threading
+import http.client
+import urllib.error
+import urllib.parse
 import urllib.request
 import datetime
-import copy
+import collections
+import concurrent.futures
+import hashlib
+import time
+import sqlite3
+import email.utils
+import random
+import socket
+import gzip
+import zlib
+import codecs
+import re
+import base64
 
 if tuple(sys.version_info[:2]) < (3, 2):
     raise Exception("Sorry, this module requires Python 3.2 or greater")
@@ -28,25 +45,316 @@ def list2dict(lst, attr):
     """Convert a list of abjects to a dictionary indexed by a specified attribute."""
     return dict([(getattr(i, attr), i) for i in lst])
 
+def period_start(date, period):
+    """Return the first day of the 'day', 'week' (starting Monday) or 'month'
+    containing date."""
+    if period == 'day':
+        return date
+    if period == 'week':
+        return date - datetime.timedelta(days=date.weekday())
+    if period == 'month':
+        return date.replace(day=1)
+    raise ValueError("Unknown period: %r" % (period,))
+
+def date_shards(date_range, period):
+    """Split a (from, to) tuple of datetime.date objects into a list of
+    consecutive (from, to) tuples, one per calendar 'week' (Monday to
+    Sunday) or 'month', clipped to the original range."""
+    (_from, _to) = date_range
+    shards = []
+    while _from <= _to:
+        if period == 'week':
+            end = _from + datetime.timedelta(days=6 - _from.weekday())
+        elif period == 'month':
+            if _from.month == 12:
+                end = datetime.date(_from.year, 12, 31)
+            else:
+                end = datetime.date(_from.year, _from.month + 1, 1) - datetime.timedelta(days=1)
+        else:
+            raise ValueError("Unknown shard period: %r" % (period,))
+        end = min(end, _to)
+        shards.append((_from, end))
+        _from = end + datetime.timedelta(days=1)
+    return shards
+
+class _TimedConnect(object):
+    """Mixin for http.client connections that records how long each phase of
+    opening the connection took, in seconds, in the timings dictionary:
+    'dns' and 'connect', plus 'tls' for HTTPS."""
+
+    timings = None
+
+    def connect(self):
+        self.timings = {}
+        start = time.perf_counter()
+        addresses = socket.getaddrinfo(self.host, self.port, 0, socket.SOCK_STREAM)
+        resolved = time.perf_counter()
+        self.timings['dns'] = resolved - start
+
+        error = None
+        for (family, socktype, proto, canonname, sockaddr) in addresses:
+            try:
+                self.sock = socket.create_connection(sockaddr[:2], self.timeout, self.source_address)
+                break
+            except OSError as e:
+                error = e
+        else:
+            raise error
+        self.timings['connect'] = time.perf_counter() - resolved
+
+        try:
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        except OSError:
+            pass
+        if self._tunnel_host:
+            self._tunnel()
+
+class TimedHTTPConnection(_TimedConnect, http.client.HTTPConnection):
+    pass
+
+class TimedHTTPSConnection(_TimedConnect, http.client.HTTPSConnection):
+
+    def connect(self):
+        _TimedConnect.connect(self)
+        start = time.perf_counter()
+        self.sock = self._context.wrap_socket(self.sock, server_hostname=self._tunnel_host or self.host)
+        self.timings['tls'] = time.perf_counter() - start
+
+class PooledResponse(object):
+    """A response obtained through a ConnectionPool.
+
+    The body is read with the 'read' method. Once the caller is done with
+    the response it must call 'close', which hands the underlying connection
+    back to the pool if the body was fully consumed and the server allows
+    the connection to be kept alive.
+
+    reused is True if the request was sent on an already open connection.
+    Otherwise timings holds the time taken by each phase of opening the new
+    connection (see _TimedConnect).
+    """
+
+    def __init__(self, pool, conn, response):
+        self.pool = pool
+        self.conn = conn
+        self.response = response
+        self.status = response.status
+        self.reason = response.reason
+        self.headers = response.msg
+        self.reused = conn.timings is None
+        self.timings = dict(conn.timings or {})
+
+    def getheader(self, name, default=None):
+        return self.response.getheader(name, default)
+
+    def read(self, amt=None):
+        data = self.response.read(amt)
+        if not data and amt and self.response.length:
+            # read(amt) reports a connection closed early as the end of the body
+            raise http.client.IncompleteRead(b'', self.response.length)
+        return data
+
+    def close(self):
+        if self.conn is None:
+            return
+        conn, self.conn = self.conn, None
+        if self.response.isclosed() and not self.response.will_close:
+            self.pool._put(conn)
+        else:
+            self.response.close()
+            conn.close()
+
+class ConnectionPool(object):
+    """A pool of persistent HTTP(S) connections to the host in url_base.
+
+    Connections are kept alive between requests and handed to whichever
+    thread needs one next, so repeated requests don't pay for a new TCP
+    and TLS handshake. At most maxsize idle connections are retained.
+
+    proxies maps URL schemes to proxy URLs, as for urllib.request.ProxyHandler.
+    Default is None which uses urllib.request.getproxies(), so the http_proxy,
+    https_proxy and no_proxy environment variables are honoured as they are
+    by urllib. HTTPS requests are tunnelled through the proxy with CONNECT.
+
+    This is the default transport of MinuteDock. Any object with the same
+    interface can be given as MinuteDock(transport=...) instead: a url_base
+    attribute, a thread-safe request(method, url, body, headers) method
+    returning a response with status, reason and headers attributes and
+    read(amt=None) and close() methods, and a close() method. See mdfake
+    for an example.
+    """
+
+    def __init__(self, url_base, ssl_context=None, maxsize=8, timeout=60, debuglevel=0, proxies=None):
+        parts = urllib.parse.urlsplit(url_base)
+        self.url_base = url_base.rstrip('/')
+        self.scheme = parts.scheme
+        self.host = parts.hostname
+        self.port = parts.port
+        self.path = parts.path.rstrip('/')
+        self.ssl_context = ssl_context
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self.debuglevel = debuglevel
+        self._idle = []
+        self._lock = threading.Lock()
+
+        # A proxy from proxies, which defaults to the *_proxy environment
+        # variables as for urllib, unless the host is excluded by no_proxy.
+        self.proxy = None
+        self._proxy_headers = {}
+        if proxies is None:
+            proxies = urllib.request.getproxies()
+        proxy = proxies.get(self.scheme)
+        if proxy and not urllib.request.proxy_bypass(parts.netloc):
+            if '://' not in proxy:
+                proxy = 'http://' + proxy
+            proxy_parts = urllib.parse.urlsplit(proxy)
+            self.proxy = (proxy_parts.hostname, proxy_parts.port or 80)
+            if proxy_parts.username is not None:
+                credentials = '%s:%s' % (urllib.parse.unquote(proxy_parts.username),
+                                         urllib.parse.unquote(proxy_parts.password or ''))
+                self._proxy_headers['Proxy-Authorization'] = \
+                    'Basic ' + base64.b64encode(credentials.encode()).decode('ascii')
+
+    def _new_connection(self):
+        host, port = self.proxy or (self.host, self.port)
+        if self.scheme == 'https':
+            conn = TimedHTTPSConnection(host, port, timeout=self.timeout, context=self.ssl_context)
+            if self.proxy is not None:
+                # Tunnel the TLS connection to the real host through the proxy
+                conn.set_tunnel(self.host, self.port, headers=self._proxy_headers)
+        else:
+            conn = TimedHTTPConnection(host, port, timeout=self.timeout)
+        conn.set_debuglevel(self.debuglevel)
+        return conn
+
+    def _get(self):
+        """Return a (connection, reused) tuple."""
+        with self._lock:
+            if self._idle:
+                return self._idle.pop(), True
+        return self._new_connection(), False
+
+    def _put(self, conn):
+        with self._lock:
+            if len(self._idle) < self.maxsize:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    def request(self, method, url, body=None, headers=None):
+        """Send a request and return a PooledResponse. url is relative
+        to url_base. If an idle connection turns out to have been dropped
+        by the server the request is transparently resent on a new one."""
+        if headers is None:
+            headers = {}
+        path = self.path + url
+        if self.proxy is not None and self.scheme != 'https':
+            # A plain HTTP proxy is sent the absolute URL
+            path = self.url_base + url
+            headers = dict(headers, **self._proxy_headers)
+        while True:
+            conn, reused = self._get()
+            # Set again by connect, if the request needs a new connection
+            conn.timings = None
+            try:
+                conn.request(method, path, body, headers)
+                response = conn.getresponse()
+            except (http.client.HTTPException, ConnectionError):
+                conn.close()
+                if reused:
+                    continue
+                raise
+            except:
+                conn.close()
+                raise
+            return PooledResponse(self, conn, response)
+
+    def close(self):
+        """Close all idle connections."""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+def _extra_fields(raw, fields):
+    """Return a dictionary of the items in raw whose keys aren't in fields, or
+    None if there are none. Every name in fields must be a key of raw."""
+    if len(raw) == len(fields):
+        return None
+    return dict([(k, v) for (k, v) in raw.items() if k not in fields])
+
+_TZINFO_CACHE = {}
+
+def _tzinfo(offset):
+    """Return the shared tzinfo for a UTC offset string such as '+10:00'."""
+    tz = _TZINFO_CACHE.get(offset)
+    if tz is None:
+        minutes = int(offset[1:3]) * 60 + int(offset[4:6])
+        if offset[0] == '-':
+            minutes = -minutes
+        tz = _TZINFO_CACHE.setdefault(offset, datetime.timezone(datetime.timedelta(minutes=minutes)))
+    return tz
+
+def parse_logged_at(value):
+    """Parse a 'logged_at' timestamp such as '2012-07-01T09:00:00+10:00' into
+    an aware datetime.
+
+    The fixed-width form sent by the API is decoded by slicing, which is much
+    faster than strptime, and all timestamps with the same UTC offset share
+    one tzinfo object. Anything else falls back to strptime."""
+    if len(value) == 25 and value[10] == 'T' and value[22] == ':':
+        tz = _TZINFO_CACHE.get(value[19:])
+        if tz is None:
+            tz = _tzinfo(value[19:])
+        return datetime.datetime(int(value[0:4]), int(value[5:7]), int(value[8:10]),
+                                 int(value[11:13]), int(value[14:16]), int(value[17:19]), 0, tz)
+    if value[-3:-2] == ':':
+        value = value[:-3] + value[-2:]
+    return datetime.datetime.strptime(value, '%Y-%m-%dT%H:%M:%S%z')
+
+def format_logged_at(date):
+    """Format an aware datetime in the ISO-8601 form used for 'logged_at'
+    (for example '2012-07-01T09:00:00+10:00'). A naive datetime is formatted
+    without an offset, as strftime('%z') would."""
+    offset = date.utcoffset()
+    if offset is None:
+        return date.strftime('%Y-%m-%dT%H:%M:%S')
+    minutes = (offset.days * 86400 + offset.seconds) // 60
+    sign = '-' if minutes < 0 else '+'
+    return "%s%s%02d:%02d" % (date.strftime('%Y-%m-%dT%H:%M:%S'), sign, abs(minutes) // 60, abs(minutes) % 60)
+
 class User(object):
     """A User object represents the underlying MinuteDock user entity.
 
     The only slightly interesting thing is the derived 'login'
     attribute, which is taken from the first half of the e-mail.
+
+    Like the other entity classes, User uses __slots__ and doesn't keep the
+    raw JSON dictionary; the 'raw' property rebuilds it from the attributes.
     """
 
+    __slots__ = ('md', 'user_id', 'email', 'login', 'first_name', 'last_name', '_extra')
+    FIELDS = frozenset(['id', 'email', 'first_name', 'last_name'])
+
     def __init__(self, md, raw):
         """Create a new User object. md is a reference to the MinuteDock
         object in which the user exists. raw a Python dictionary that has
         been created from raw JSON."""
         self.md = md
-        self.raw = raw
 
         self.user_id = raw['id']
         self.email = raw['email']
         self.login = self.email.split('@')[0]
         self.first_name = raw['first_name']
         self.last_name = raw['last_name']
+        self._extra = _extra_fields(raw, self.FIELDS)
+
+    @property
+    def raw(self):
+        raw = dict(self._extra or ())
+        raw.update({'id': self.user_id, 'email': self.email,
+                    'first_name': self.first_name, 'last_name': self.last_name})
+        return raw
 
     def __str__(self):
         return self.login
@@ -54,17 +362,27 @@ class User(object):
 class Contact(object):
     """A User object represents the underlying MinuteDock contact entity."""
 
+    __slots__ = ('md', 'contact_id', 'name', 'short_code', 'default_rate_dollars', '_extra')
+    FIELDS = frozenset(['id', 'name', 'short_code', 'default_rate_dollars'])
+
     def __init__(self, md, raw):
         """Create a new Contact object. md is a reference to the MinuteDock
         object in which the user exists. raw a Python dictionary that has
         been created from raw JSON."""
         self.md = md
-        self.raw = raw
 
         self.contact_id = raw['id']
         self.name = raw['name']
         self.short_code = raw['short_code']
         self.default_rate_dollars = raw['default_rate_dollars']
+        self._extra = _extra_fields(raw, self.FIELDS)
+
+    @property
+    def raw(self):
+        raw = dict(self._extra or ())
+        raw.update({'id': self.contact_id, 'name': self.name, 'short_code': self.short_code,
+                    'default_rate_dollars': self.default_rate_dollars})
+        return raw
 
     def __str__(self):
         return self.short_code
@@ -72,12 +390,15 @@ class Contact(object):
 class Project(object):
     """A Project object represents the underlying MinuteDock project entity."""
 
+    __slots__ = ('md', 'project_id', 'contact_id', 'name', 'short_code', 'description',
+                 'default_rate_dollars', '_extra')
+    FIELDS = frozenset(['id', 'contact_id', 'name', 'short_code', 'description', 'default_rate_dollars'])
+
     def __init__(self, md, raw):
         """Create a new Project object. md is a reference to the MinuteDock
         object in which the user exists. raw a Python dictionary that has
         been created from raw JSON."""
         self.md = md
-        self.raw = raw
 
         self.project_id = raw['id']
         self.contact_id = raw['contact_id']
@@ -86,7 +407,16 @@ class Project(object):
         self.short_code = raw['short_code']
         self.description = raw['description']
         self.default_rate_dollars = raw['default_rate_dollars']
-        
+        self._extra = _extra_fields(raw, self.FIELDS)
+
+    @property
+    def raw(self):
+        raw = dict(self._extra or ())
+        raw.update({'id': self.project_id, 'contact_id': self.contact_id, 'name': self.name,
+                    'short_code': self.short_code, 'description': self.description,
+                    'default_rate_dollars': self.default_rate_dollars})
+        return raw
+
     def __str__(self):
         return self.short_code
 
@@ -99,27 +429,105 @@ class Entry(object):
     modified.
 
     Any modifications to the object is not synced to the server until the
-    'update' method is called.
+    'update' method is called. The entry tracks which fields have been
+    changed through these methods and attributes (see dirty_fields), and
+    'update' does nothing if none have. Changes made by assigning to other
+    attributes are not tracked; use update(force=True) to send them.
+
+    The 'raw' property rebuilds the JSON dictionary from the current
+    attribute values, so it reflects any local modifications.
+
+    The 'logged_at' timestamp is kept as a string until the date attribute
+    is first used, so entries that are discarded by filtering on other
+    attributes never pay for parsing it.
     """
 
+    __slots__ = ('md', 'entry_id', 'user_id', 'contact_id', 'project_id', 'duration', '_description',
+                 'timer_active', '_logged_at', '_date', '_extra', '_dirty')
+    FIELDS = frozenset(['id', 'user_id', 'contact_id', 'project_id', 'duration', 'description',
+                        'timer_active', 'logged_at'])
+
     def __init__(self, md, raw):
         """Create a new Entry object. md is a reference to the MinuteDock
         object in which the user exists. raw a Python dictionary that has
         been created from raw JSON."""
         self.md = md
-        self.raw = raw
 
         self.entry_id = raw['id']
         self.user_id = raw['user_id']
         self.contact_id = raw['contact_id']
         self.project_id = raw['project_id']
         self.duration = raw['duration']
-        self.description = raw['description']
+        self._description = raw['description']
         self.timer_active = raw['timer_active']
 
-        date = raw['logged_at']
-        date = date[:-3] + date[-2:]
-        self.date = datetime.datetime.strptime(date, '%Y-%m-%dT%H:%M:%S%z')
+        # The date is only parsed when first used; see the date property.
+        self._logged_at = raw['logged_at']
+        self._date = None
+        self._extra = _extra_fields(raw, self.FIELDS)
+        self._dirty = None
+
+    def _mark_dirty(self, field):
+        if self._dirty is None:
+            self._dirty = set()
+        self._dirty.add(field)
+
+    @property
+    def dirty_fields(self):
+        """The set of fields changed since the entry was fetched or last updated."""
+        return frozenset(self._dirty or ())
+
+    @property
+    def is_dirty(self):
+        return bool(self._dirty)
+
+    @property
+    def changes(self):
+        """A dictionary of just the changed fields, keyed as in raw."""
+        changes = {}
+        for field in self._dirty or ():
+            if field == 'logged_at':
+                changes[field] = self._logged_at or format_logged_at(self._date)
+            else:
+                changes[field] = getattr(self, field)
+        return changes
+
+    @property
+    def description(self):
+        return self._description
+
+    @description.setter
+    def description(self, value):
+        if value != self._description:
+            self._description = value
+            self._mark_dirty('description')
+
+    @property
+    def date(self):
+        """The entry's 'logged_at' time as an aware datetime."""
+        if self._date is None:
+            self._date = parse_logged_at(self._logged_at)
+        return self._date
+
+    @date.setter
+    def date(self, value):
+        if value.utcoffset() is None:
+            raise ValueError("Entry.date must be an aware datetime (with a tzinfo), not %r" % (value,))
+        # The offset decides the local day the entry is filed under, so a
+        # change of offset alone is a change
+        if value != self.date or value.utcoffset() != self.date.utcoffset():
+            self._date = value
+            self._logged_at = None
+            self._mark_dirty('logged_at')
+
+    @property
+    def raw(self):
+        raw = dict(self._extra or ())
+        raw.update({'id': self.entry_id, 'user_id': self.user_id, 'contact_id': self.contact_id,
+                    'project_id': self.project_id, 'duration': self.duration,
+                    'description': self._description, 'timer_active': self.timer_active,
+                    'logged_at': self._logged_at or format_logged_at(self._date)})
+        return raw
 
     def __str__(self):
         user = self.md.users_by_id[self.user_id]
@@ -132,112 +540,654 @@ class Entry(object):
     def change_contact(self, contact_code):
         """Change the entry's contact. contact_code is the 'short_code' associated with
         an existing contact. The back-end object is not changed until update is called."""
-        self.contact_id = self.md.contacts_by_code[contact_code].contact_id
+        contact_id = self.md.contacts_by_code[contact_code].contact_id
+        if contact_id != self.contact_id:
+            self.contact_id = contact_id
+            self._mark_dirty('contact_id')
 
     def change_project(self, project_code):
         """Change the entry's project. project_code is the 'short_code' associated with
         an existing project. The back-end object is not changed until update is called."""
-        self.project_id = self.md.projects_by_code[project_code].project_id
+        project_id = self.md.projects_by_code[project_code].project_id
+        if project_id != self.project_id:
+            self.project_id = project_id
+            self._mark_dirty('project_id')
 
-    def update(self):
-        """Update the backend copy of this object."""
-        new_raw = copy.copy(self.raw)
+    def update(self, force=False):
+        """Update the backend copy of this object if it has been changed, or
+        unconditionally if force is True. For entries obtained through an
+        AsyncMinuteDock this returns a coroutine which must be awaited."""
+        # raw is built from the current attributes. We don't update
+        # timer_active. Can't change it through this interface
+        return self.md._put_entry(self, force)
 
-        new_raw['user_id'] = self.user_id
-        new_raw['contact_id'] = self.contact_id
-        new_raw['project_id'] = self.project_id
-        new_raw['description'] = self.description
-        new_raw['logged_at'] = self.date.strftime('%Y-%m-%dT%H:%M:%S%z')
-        # We don't update timer_active. Can't change it through this interface
 
-        self.md._do_put('entries/%s.json' % self.entry_id, {'entry' : new_raw})
+class ReferenceCache(object):
+    """A file based cache of the raw users, contacts and projects lists, so a
+    MinuteDock object can be created without querying the API.
 
+    Cached data older than ttl seconds is ignored. The cache is keyed on the
+    API key and base URL, so data for one account is never served to
+    another.
+    """
 
-class MinuteDock(object):
-    """The MinuteDock object represents an user or organisation's MinuteDock
-    data. On creation it will query the MinuteDock API to obtain a list of all
-    users, contacts and projects. These are available through named attributes.
+    DEFAULT_PATH = "~/.md.cache"
 
-    Additional dictionaries are created to perform key-based lookups:
+    def __init__(self, path=None, ttl=3600):
+        """Create a ReferenceCache. path defaults to DEFAULT_PATH."""
+        if path is None:
+            path = self.DEFAULT_PATH
+        self.path = os.path.expanduser(path)
+        self.ttl = ttl
 
-    - users_by_id: User objects indexed by id.
-    - users_by_login: User objects indexed by login name.
-    - contacts_by_id: Contact objects indexed by id.
-    - contacts_by_code: Contact objects indexed by short code.
-    - projects_by_id: Project objects indexed by id.
-    - projects_by_code: Project objects indexed by short code.
+    def _key(self, api_key, url_base):
+        return hashlib.sha256(('%s %s' % (url_base, api_key)).encode()).hexdigest()
+
+    def load(self, api_key, url_base):
+        """Return a (users, contacts, projects) tuple of raw lists, or None if
+        there is no fresh cached copy."""
+        try:
+            with open(self.path) as f:
+                cached = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        if not isinstance(cached, dict) or cached.get('key') != self._key(api_key, url_base):
+            return None
+        try:
+            if time.time() - cached['time'] > self.ttl:
+                return None
+            return (cached['users'], cached['contacts'], cached['projects'])
+        except (KeyError, TypeError):
+            return None
+
+    def store(self, api_key, url_base, users, contacts, projects):
+        """Write the raw lists to the cache file. The cache is best effort, so
+        if the file can't be written it is left as it was."""
+        cached = {'key': self._key(api_key, url_base), 'time': time.time(),
+                  'users': users, 'contacts': contacts, 'projects': projects}
+        tmp_path = '%s.%d.tmp' % (self.path, os.getpid())
+        try:
+            with os.fdopen(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as f:
+                json.dump(cached, f)
+            os.replace(tmp_path, self.path)
+        except OSError:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+    def invalidate(self):
+        """Remove the cache file."""
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+class TokenBucket(object):
+    """A thread-safe token bucket limiting an average rate (per second) of
+    operations, while allowing bursts of up to burst operations."""
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """Take a token. Returns the number of seconds the caller must wait
+        before going ahead."""
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.rate
+
+    def acquire(self):
+        """Take a token, sleeping until it may be used."""
+        delay = self.reserve()
+        if delay > 0:
+            time.sleep(delay)
+
+def retry_after(headers, default=None):
+    """Return the delay, in seconds, requested by a Retry-After header in
+    headers, or default if there is none."""
+    value = headers.get('Retry-After') if headers is not None else None
+    if value is None:
+        return default
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        date = email.utils.parsedate_tz(value)
+        if date is None:
+            return default
+        return max(0.0, email.utils.mktime_tz(date) - time.time())
+
+def _url_error(error):
+    """Return error wrapped in urllib.error.URLError if it is a network error
+    (an OSError), as urllib.request.urlopen raises them, or else error itself."""
+    if isinstance(error, OSError) and not isinstance(error, urllib.error.URLError):
+        wrapped = urllib.error.URLError(error)
+        wrapped.__cause__ = error
+        return wrapped
+    return error
+
+class RetryPolicy(object):
+    """Controls how MinuteDock retries failed requests and paces requests.
+
+    Network errors and responses with a status in RETRY_STATUSES are retried
+    up to max_retries times. The delay before each retry is the Retry-After
+    value sent by the server if there is one, and otherwise a random delay of
+    up to backoff * 2 ** attempt seconds (capped at max_backoff). A 429 or 503
+    response with a Retry-After header pauses all requests sharing the policy,
+    not just the one that was rejected.
+
+    If rate is given, requests are also limited to that many per second
+    (allowing bursts of burst requests) by a TokenBucket.
     """
 
-    URL_BASE = 'https://minutedock.com/api/v1'
+    RETRY_STATUSES = frozenset([429, 502, 503, 504])
+    RETRY_ERRORS = (ConnectionError, socket.timeout, http.client.HTTPException)
+
+    def __init__(self, max_retries=4, backoff=0.5, max_backoff=30.0, rate=None, burst=1):
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.bucket = TokenBucket(rate, burst) if rate else None
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def reserve(self):
+        """Return the number of seconds to wait before sending a request."""
+        delay = self._paused_until - time.monotonic()
+        if self.bucket is not None:
+            delay = max(delay, self.bucket.reserve())
+        return max(delay, 0.0)
+
+    def retry_delay(self, attempt, status=None, headers=None):
+        """Return the number of seconds to wait before retry number attempt
+        (counting from 0) of a request that failed with status (None for a
+        network error), or None if it should not be retried."""
+        if attempt >= self.max_retries:
+            return None
+        if status is not None and status not in self.RETRY_STATUSES:
+            return None
+        delay = retry_after(headers)
+        if delay is None:
+            return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+        if status in (429, 503):
+            with self._lock:
+                self._paused_until = max(self._paused_until, time.monotonic() + delay)
+        return delay
+
+def decode_body(data, content_encoding):
+    """Decode a response body sent with the given Content-Encoding ('gzip',
+    'deflate', 'identity' or None)."""
+    encoding = (content_encoding or 'identity').strip().lower()
+    if encoding == 'identity':
+        return data
+    if encoding in ('gzip', 'x-gzip'):
+        return gzip.decompress(data)
+    if encoding == 'deflate':
+        try:
+            return zlib.decompress(data)
+        except zlib.error:
+            # Some servers send a raw deflate stream without the zlib header
+            return zlib.decompress(data, -zlib.MAX_WBITS)
+    raise ValueError("Unsupported Content-Encoding: %r" % (content_encoding,))
+
+def iter_json_array(chunks):
+    """Incrementally decode a JSON array from an iterable of bytes chunks
+    (UTF-8), yielding each element as soon as it is complete. Only the
+    undecoded remainder of the current chunk is held in memory, never the
+    whole document."""
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder('utf-8')()
+    whitespace = ' \t\n\r'
+    buf = ''
+    pos = 0
+    state = 'start'
+    final = False
+    chunks = iter(chunks)
+
+    while not final:
+        try:
+            text = text_decoder.decode(next(chunks))
+        except StopIteration:
+            text = text_decoder.decode(b'', True)
+            final = True
+        buf = buf[pos:] + text
+        pos = 0
+
+        while True:
+            while pos < len(buf) and buf[pos] in whitespace:
+                pos += 1
+            if pos == len(buf):
+                break
+            if state == 'start':
+                if buf[pos] != '[':
+                    raise ValueError("Expected a JSON array")
+                pos += 1
+                state = 'first'
+            elif state == 'first' and buf[pos] == ']':
+                pos += 1
+                state = 'end'
+            elif state in ('first', 'value'):
+                try:
+                    (obj, end) = decoder.raw_decode(buf, pos)
+                except ValueError:
+                    if final:
+                        raise
+                    break
+                if (not final and isinstance(obj, (int, float)) and not isinstance(obj, bool)
+                        and (end == len(buf) or buf[end] not in whitespace + ',]')):
+                    # The number may continue in the next chunk, as in '123.' + '45'
+                    break
+                yield obj
+                pos = end
+                state = 'separator'
+            elif state == 'separator':
+                if buf[pos] == ',':
+                    state = 'value'
+                elif buf[pos] == ']':
+                    state = 'end'
+                else:
+                    raise ValueError("Expected ',' or ']' at %r" % (buf[pos:pos + 20],))
+                pos += 1
+            else:
+                raise ValueError("Unexpected data after JSON array")
+
+    if state != 'end':
+        raise ValueError("Truncated JSON array")
+
+class TransferStats(object):
+    """Counters of the response bytes received over the network, the bytes
+    they decoded to, and the time spent decoding them."""
+
     def __init__(self):
-        """Create a MinuteDock object. Can throw any file related
-        exception when attempting to obtain the API key."""
-        key_file = os.path.expanduser("~/.md.key")
-        self.users = {}
-        self.contacts = {}
+        self.responses = 0
+        self.bytes_on_wire = 0
+        self.bytes_decoded = 0
+        self.decode_time = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, bytes_on_wire, bytes_decoded, decode_time):
+        with self._lock:
+            self.responses += 1
+            self.bytes_on_wire += bytes_on_wire
+            self.bytes_decoded += bytes_decoded
+            self.decode_time += decode_time
+
+    @property
+    def compression_ratio(self):
+        """bytes_decoded / bytes_on_wire, or None if nothing has been received."""
+        if self.bytes_on_wire == 0:
+            return None
+        return self.bytes_decoded / float(self.bytes_on_wire)
+
+    def __repr__(self):
+        return "<TransferStats responses=%d bytes_on_wire=%d bytes_decoded=%d decode_time=%.3fs>" % \
+            (self.responses, self.bytes_on_wire, self.bytes_decoded, self.decode_time)
+
+class RequestEvent(object):
+    """A record of one HTTP request attempt, passed to each of a MinuteDock's
+    observers once the response body has been read or the attempt failed.
+
+    method, endpoint: The HTTP method and API endpoint, such as 'entries.json'.
+    offset: The 'offset' argument of an entries.json page request, or None.
+    attempt: 0 for the first attempt, 1 for the first retry and so on.
+    status: The HTTP status, or None if no response was received.
+    error: The exception that made the attempt fail, or None.
+    bytes_on_wire, bytes_decoded: The size of the response body as received
+      and after decompression.
+    reused: True if the request was sent on a kept-alive connection, or None
+      if the transport doesn't say.
+    dns, connect, tls: Seconds spent resolving the host, making the TCP
+      connection and the TLS handshake, or None if the request did not open
+      a new connection (or the transport doesn't record them).
+    first_byte: Seconds from starting the attempt to receiving the response
+      headers.
+    total: Seconds from starting the attempt until it finished.
+    """
+
+    __slots__ = ('method', 'endpoint', 'offset', 'attempt', 'status', 'error', 'bytes_on_wire',
+                 'bytes_decoded', 'reused', 'dns', 'connect', 'tls', 'first_byte', 'total', '_start')
+
+    def __init__(self, method, endpoint, args=None, attempt=0):
+        self.method = method
+        self.endpoint = endpoint
+        offset = args.get('offset') if args else None
+        self.offset = int(offset) if offset is not None else None
+        self.attempt = attempt
+        self.status = None
+        self.error = None
+        self.bytes_on_wire = 0
+        self.bytes_decoded = 0
+        self.reused = None
+        self.dns = self.connect = self.tls = None
+        self.first_byte = None
+        self.total = None
+        self._start = time.perf_counter()
+
+    def response_received(self, response):
+        """Record the status line and connection details of response."""
+        self.first_byte = time.perf_counter() - self._start
+        self.status = response.status
+        self.reused = getattr(response, 'reused', None)
+        timings = getattr(response, 'timings', None) or {}
+        self.dns = timings.get('dns')
+        self.connect = timings.get('connect')
+        self.tls = timings.get('tls')
+
+    def finish(self, error=None):
+        self.total = time.perf_counter() - self._start
+        self.error = error
+
+    def __repr__(self):
+        return "<RequestEvent %s %s offset=%s attempt=%d status=%s bytes=%d total=%s>" % \
+            (self.method, self.endpoint, self.offset, self.attempt, self.status, self.bytes_on_wire,
+             '%.3fs' % self.total if self.total is not None else None)
+
+class RequestMetrics(object):
+    """An observer (see MinuteDock's observers argument) that aggregates
+    RequestEvents per method and endpoint, with entry ids in endpoints
+    replaced by '{id}'. The most recent max_samples timings of each kind are
+    kept per endpoint for percentiles.
+
+        metrics = RequestMetrics()
+        md = MinuteDock(observers=[metrics])
+        md.entries_search(...)
+        print(metrics.format())
+    """
+
+    TIMINGS = ('dns', 'connect', 'tls', 'first_byte', 'total')
+
+    def __init__(self, max_samples=10000):
+        self.max_samples = max_samples
+        self._endpoints = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, event):
+        key = '%s %s' % (event.method, re.sub(r'/\d+', '/{id}', event.endpoint))
+        with self._lock:
+            m = self._endpoints.get(key)
+            if m is None:
+                m = self._endpoints[key] = {
+                    'requests': 0, 'retries': 0, 'errors': 0, 'new_connections': 0,
+                    'statuses': collections.Counter(), 'bytes_on_wire': 0, 'bytes_decoded': 0,
+                    'timings': dict([(t, collections.deque(maxlen=self.max_samples)) for t in self.TIMINGS])}
+            m['requests'] += 1
+            if event.attempt > 0:
+                m['retries'] += 1
+            if event.error is not None or (event.status is not None and event.status >= 400):
+                m['errors'] += 1
+            if event.reused is False:
+                m['new_connections'] += 1
+            m['statuses'][event.status] += 1
+            m['bytes_on_wire'] += event.bytes_on_wire
+            m['bytes_decoded'] += event.bytes_decoded
+            for t in self.TIMINGS:
+                value = getattr(event, t)
+                if value is not None:
+                    m['timings'][t].append(value)
+
+    @staticmethod
+    def _summary(samples):
+        ordered = sorted(samples)
+        n = len(ordered)
+        return {'count': n, 'mean': sum(ordered) / n, 'p50': ordered[(n - 1) // 2],
+                'p90': ordered[int((n - 1) * 0.9)], 'p99': ordered[int((n - 1) * 0.99)], 'max': ordered[-1]}
+
+    def snapshot(self):
+        """Return a dictionary mapping each 'METHOD endpoint' to a dictionary of
+        its counters and, for each timing recorded, a dictionary of its count,
+        mean, p50, p90, p99 and max in seconds."""
+        with self._lock:
+            result = {}
+            for (key, m) in self._endpoints.items():
+                r = dict(m)
+                r['statuses'] = dict(m['statuses'])
+                r['timings'] = dict([(t, self._summary(samples)) for (t, samples) in m['timings'].items()
+                                     if samples])
+                result[key] = r
+            return result
+
+    def reset(self):
+        with self._lock:
+            self._endpoints = {}
+
+    def format(self):
+        """Return the snapshot as a human readable table."""
+        lines = []
+        for (key, m) in sorted(self.snapshot().items()):
+            lines.append("%s: %d requests, %d retries, %d errors, %d new connections, %d bytes (%d decoded)" %
+                         (key, m['requests'], m['retries'], m['errors'], m['new_connections'],
+                          m['bytes_on_wire'], m['bytes_decoded']))
+            for t in self.TIMINGS:
+                if t in m['timings']:
+                    lines.append("  %-10s mean %8.1fms  p50 %8.1fms  p90 %8.1fms  p99 %8.1fms  max %8.1fms" %
+                                 ((t,) + tuple([m['timings'][t][k] * 1e3
+                                                for k in ('mean', 'p50', 'p90', 'p99', 'max')])))
+        return "\n".join(lines)
+
+UpdateResult = collections.namedtuple('UpdateResult', 'entry error')
+
+class QueryCache(object):
+    """A cache of entries_search results keyed on the API key, base URL and
+    normalised query, so one cache can be shared by several accounts without
+    results for one ever being served to another.
+
+    Results are kept in memory in least-recently-used order. When the
+    estimated size of the cached results exceeds max_bytes the least recently
+    used are evicted. Results older than ttl seconds are never returned.
+
+    If path is given, results are also written to a SQLite database at that
+    path, so they survive between processes; results evicted from memory are
+    then reloaded from disk while they are still fresh. As it holds entry
+    descriptions the database is created readable by its owner only.
+
+    Updating an entry through Entry.update invalidates every cached result
+    that holds that entry, or that could hold it after the update.
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024, ttl=300, path=None):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size = 0
+        self._items = collections.OrderedDict()  # key -> (time, size, raw entries)
+        self._keys_by_entry = {}
+        self._lock = threading.Lock()
+        self.db = None
+        if path is not None:
+            path = os.path.expanduser(path)
+            os.close(os.open(path, os.O_WRONLY | os.O_CREAT, 0o600))
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            with self.db:
+                self.db.execute("CREATE TABLE IF NOT EXISTS results "
+                                "(key TEXT PRIMARY KEY, time REAL, entries TEXT)")
+                self.db.execute("CREATE TABLE IF NOT EXISTS result_entries (key TEXT, entry_id INTEGER)")
+                self.db.execute("CREATE INDEX IF NOT EXISTS result_entries_entry_id "
+                                "ON result_entries (entry_id)")
+
+    def _key(self, api_key, url_base, search_dict):
+        query = dict(search_dict)
+        # Not an 'entries.json' argument, so it can't clash with the query
+        query['account'] = hashlib.sha256(('%s %s' % (url_base, api_key)).encode()).hexdigest()
+        for name in ('users', 'contacts', 'projects'):
+            if query.get(name, 'all') != 'all':
+                query[name] = ','.join(sorted(query[name].split(','), key=lambda x: (len(x), x)))
+        return json.dumps(query, sort_keys=True)
+
+    def get(self, api_key, url_base, search_dict):
+        """Return the cached raw entries for search_dict, or None."""
+        key = self._key(api_key, url_base, search_dict)
+        now = time.time()
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None:
+                if now - item[0] <= self.ttl:
+                    self._items.move_to_end(key)
+                    return item[2]
+                self._discard(key)
+            if self.db is not None:
+                row = self.db.execute("SELECT time, entries FROM results WHERE key = ?", (key,)).fetchone()
+                if row is not None and now - row[0] <= self.ttl:
+                    entries = json.loads(row[1])
+                    self._add(key, row[0], len(row[1]), entries)
+                    return entries
+        return None
+
+    def put(self, api_key, url_base, search_dict, entries):
+        """Cache the raw entries returned for search_dict."""
+        key = self._key(api_key, url_base, search_dict)
+        now = time.time()
+        data = json.dumps(entries)
+        with self._lock:
+            self._discard(key)
+            self._add(key, now, len(data), entries)
+            if self.db is not None:
+                with self.db:
+                    self.db.execute("DELETE FROM result_entries WHERE key = ?", (key,))
+                    self.db.execute("INSERT OR REPLACE INTO results VALUES (?, ?, ?)", (key, now, data))
+                    self.db.executemany("INSERT INTO result_entries VALUES (?, ?)",
+                                        [(key, e['id']) for e in entries])
+
+    def _add(self, key, when, size, entries):
+        if size > self.max_bytes:
+            return
+        self._items[key] = (when, size, entries)
+        self.size += size
+        for e in entries:
+            self._keys_by_entry.setdefault(e['id'], set()).add(key)
+        while self.size > self.max_bytes:
+            self._discard(next(iter(self._items)))
+
+    def _discard(self, key):
+        """Remove key from memory."""
+        item = self._items.pop(key, None)
+        if item is None:
+            return
+        self.size -= item[1]
+        for e in item[2]:
+            keys = self._keys_by_entry.get(e['id'])
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._keys_by_entry[e['id']]
+
+    def _could_match(self, key, raw):
+        """Whether the query in key could return the entry raw."""
+        query = json.loads(key)
+        for (name, attr) in (('users', 'user_id'), ('contacts', 'contact_id'), ('projects', 'project_id')):
+            ids = query.get(name, 'all')
+            if ids != 'all' and raw[attr] is not None and str(raw[attr]) not in ids.split(','):
+                return False
+        if 'from' in query:
+            fmt = '%m/%d/%Y'
+            logged_on = raw['logged_at'][:10]
+            _from = datetime.datetime.strptime(query['from'], fmt).strftime('%Y-%m-%d')
+            _to = datetime.datetime.strptime(query['to'], fmt).strftime('%Y-%m-%d')
+            if not _from <= logged_on <= _to:
+                return False
+        return True
+
+    def invalidate_entry(self, entry_id, raw=None):
+        """Drop all results that hold entry_id, and all results whose query
+        could match the (updated) raw entry, if given."""
+        with self._lock:
+            keys = set(self._keys_by_entry.get(entry_id, ()))
+            if raw is not None:
+                keys.update([k for k in self._items if self._could_match(k, raw)])
+            if self.db is not None:
+                keys.update([row[0] for row in self.db.execute(
+                    "SELECT key FROM result_entries WHERE entry_id = ?", (entry_id,))])
+                if raw is not None:
+                    keys.update([row[0] for row in self.db.execute("SELECT key FROM results")
+                                 if self._could_match(row[0], raw)])
+            for key in keys:
+                self._discard(key)
+            if self.db is not None and keys:
+                with self.db:
+                    self.db.executemany("DELETE FROM results WHERE key = ?", [(k,) for k in keys])
+                    self.db.executemany("DELETE FROM result_entries WHERE key = ?", [(k,) for k in keys])
 
-        self.api_key = open(key_file).read().strip()
+    def clear(self):
+        """Drop all cached results."""
+        with self._lock:
+            self._items.clear()
+            self._keys_by_entry.clear()
+            self.size = 0
+            if self.db is not None:
+                with self.db:
+                    self.db.execute("DELETE FROM results")
+                    self.db.execute("DELETE FROM result_entries")
 
+class BaseMinuteDock(object):
+    """Functionality shared by MinuteDock and the asyncio based AsyncMinuteDock
+    (in the aiomd module): building the reference data indexes, building
+    search queries and post-processing search results. It does no I/O itself.
+    """
+
+    URL_BASE = 'https://minutedock.com/api/v1'
+    KEY_FILE = "~/.md.key"
+
+    def _read_api_key(self, api_key):
+        """Return api_key, or the key stored in KEY_FILE if api_key is None."""
+        if api_key is None:
+            api_key = open(os.path.expanduser(self.KEY_FILE)).read().strip()
+        return api_key
+
+    def _ssl_context(self):
         ssl_ctxt = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
         ssl_ctxt.set_default_verify_paths()
         ssl_ctxt.verify_mode = ssl.CERT_REQUIRED
-        https_handler = urllib.request.HTTPSHandler(debuglevel=5, context=ssl_ctxt)
-        self.opener = urllib.request.build_opener(https_handler)
+        return ssl_ctxt
 
-        self.users = [User(self, u) for u in self._do_get('users.json')]
+    def _set_reference_data(self, users, contacts, projects):
+        """Build the user, contact and project lists and indexes from raw JSON lists."""
+        self.users = [User(self, u) for u in users]
         self.users_by_id = list2dict(self.users, 'user_id')
         self.users_by_login = list2dict(self.users, 'login')
 
-        self.contacts = [Contact(self, c) for c in self._do_get('contacts.json')]
+        self.contacts = [Contact(self, c) for c in contacts]
         self.contacts_by_id = list2dict(self.contacts, 'contact_id')
         self.contacts_by_code = list2dict(self.contacts, 'short_code')
 
-        self.projects = [Project(self, c) for c in self._do_get('projects.json')]
+        self.projects = [Project(self, c) for c in projects]
         self.projects_by_id = list2dict(self.projects, 'project_id')
         self.projects_by_code = list2dict(self.projects, 'short_code')
 
-    def _do_get(self, req, args=None):
-        """Internal function to perform 'GET' requests."""
-        if args is None:
-            args = {}
-        args['api_key'] = self.api_key
-        str_args = '&'.join(['%s=%s' % i for i in args.items()])
-        url = "%s/%s?%s" % (self.URL_BASE, req, str_args)
-        req = urllib.request.Request(url)
-        req.get_method = lambda: 'GET'
-        response = self.opener.open(req)
-        data = response.read()
-        return json.loads(data.decode())
-
-    def _do_put(self, req, obj):
-        """Internal function to perform 'PUT' requests."""
-        args = {'api_key': self.api_key}
-        str_args = '&'.join(['%s=%s' % i for i in args.items()])
-        url = "%s/%s?%s" % (self.URL_BASE, req, str_args)
-        upload_data = json.dumps(obj).encode()
-        req = urllib.request.Request(url, data=upload_data)
-        req.add_header('Content-Type', 'application/json')
-        req.get_method = lambda: 'PUT'
-        response = self.opener.open(req)
-        data = response.read()
-
-    def entries_search(self, date_range=None, user_logins=None, contacts=None, projects=None):
-        """Search for entries that match the search criteria.
+    def _url(self, req, args=None):
+        """Return the path and query string, relative to the base URL, for a request."""
+        query = dict(args) if args else {}
+        query['api_key'] = self.api_key
+        str_args = '&'.join(['%s=%s' % i for i in query.items()])
+        return "/%s?%s" % (req, str_args)
 
-        date_range: A tuple of datetime.date object to restrict the search. Default is None
-          which represents current week.
+    def _request_headers(self, headers=None):
+        """Return the headers to send with a request."""
+        headers = dict(headers) if headers else {}
+        if self.compression:
+            headers.setdefault('Accept-Encoding', 'gzip, deflate')
+        return headers
 
-        user_logins: List of user logins to restrict search by. Default is None which
-          represents all users.
+    def _decode_body(self, headers, data):
+        """Decode a response body according to its Content-Encoding, updating stats."""
+        start = time.perf_counter()
+        decoded = decode_body(data, headers.get('Content-Encoding'))
+        self.stats.record(len(data), len(decoded), time.perf_counter() - start)
+        return decoded
 
-        contacts: List of contact short codes to restrict search by. Default is None which
-          represents all contacts.
+    def _check_response(self, url, status, reason, headers, data):
+        """Raise urllib.error.HTTPError if status is an error status."""
+        if status >= 400:
+            raise urllib.error.HTTPError(url, status, reason, headers, io.BytesIO(data))
 
-        projects: List of project short codes to restict search by. Default is None which
-          represents all contacts. If list is empty return entries with no project set.
-        """
-        entries = []
-        offset = 0
+    def _search_dict(self, date_range=None, user_logins=None, contacts=None, projects=None):
+        """Return the 'entries.json' query arguments for a search. See entries_search."""
         search_dict = {}
 
         if user_logins is None:
@@ -261,19 +1211,492 @@ class MinuteDock(object):
             search_dict['from'] = _from.strftime(fmt)
             search_dict['to'] = _to.strftime(fmt)
 
-        while True:
-            search_dict['offset'] = str(offset)
-            new_entries = self._do_get('entries.json', search_dict)
-            if len(new_entries) == 0:
-                break
+        return search_dict
+
+    def _shard_dicts(self, search_dict, date_range, shard):
+        """Return a copy of search_dict for each shard of date_range."""
+        fmt = '%m/%d/%Y'
+        shard_dicts = []
+        for (_from, _to) in date_shards(date_range, shard):
+            shard_dict = dict(search_dict)
+            shard_dict['from'] = _from.strftime(fmt)
+            shard_dict['to'] = _to.strftime(fmt)
+            shard_dicts.append(shard_dict)
+        return shard_dicts
+
+    def _merge_shards(self, results):
+        """Concatenate per-shard lists of raw entries, removing duplicates (by id)."""
+        entries = []
+        seen = set()
+        for result in results:
+            for e in result:
+                if e['id'] not in seen:
+                    seen.add(e['id'])
+                    entries.append(e)
+        return entries
+
+    def _entry_payload(self, entry, force=False):
+        """Return the body of the PUT request updating entry, or None if
+        there is nothing to send."""
+        if not (force or entry.is_dirty):
+            return None
+        # A forced update may be sending untracked changes, so it sends everything
+        if self.partial_updates and not force:
+            return {'entry': entry.changes}
+        return {'entry': entry.raw}
 
-            entries += new_entries
-            offset += len(new_entries)
+    def _notify(self, event, error=None):
+        """Internal function to complete event and pass it to the observers."""
+        if self.observers:
+            event.finish(error)
+            for observer in self.observers:
+                observer(event)
 
-        entries = [Entry(self, e) for e in entries]
+    def _entry_updated(self, entry):
+        """Called after an entry has been updated on the server."""
+        entry._dirty = None
+        if self.query_cache is not None:
+            self.query_cache.invalidate_entry(entry.entry_id, entry.raw)
 
+    def _filter_raw(self, raw_entries, projects=None):
+        """Apply the client side filtering of search results."""
         # Hack: Only needed because you can't search usefully otherwise
         if projects is not None and len(projects) == 0:
-            entries = [e for e in entries if e.project_id is None]
+            raw_entries = (e for e in raw_entries if e['project_id'] is None)
+        return raw_entries
+
+    def _make_entries(self, raw_entries, projects=None):
+        """Create Entry objects from raw search results."""
+        return [Entry(self, e) for e in self._filter_raw(raw_entries, projects)]
+
+    def _make_table(self, raw_entries, projects=None):
+        """Create an EntryTable from raw search results."""
+        from mdtable import EntryTable
+        return EntryTable.from_raw(self, self._filter_raw(raw_entries, projects))
+
+    def _make_result(self, raw_entries, projects=None, as_table=False):
+        if as_table:
+            return self._make_table(raw_entries, projects)
+        return self._make_entries(raw_entries, projects)
+
+
+class MinuteDock(BaseMinuteDock):
+    """The MinuteDock object represents an user or organisation's MinuteDock
+    data. On creation it will query the MinuteDock API to obtain a list of all
+    users, contacts and projects. These are available through named attributes.
+    (When created with lazy=True the query is deferred until one of these
+    attributes is first used.)
+
+    Additional dictionaries are created to perform key-based lookups:
+
+    - users_by_id: User objects indexed by id.
+    - users_by_login: User objects indexed by login name.
+    - contacts_by_id: Contact objects indexed by id.
+    - contacts_by_code: Contact objects indexed by short code.
+    - projects_by_id: Project objects indexed by id.
+    - projects_by_code: Project objects indexed by short code.
+    """
+
+    REFERENCE_ATTRS = ('users', 'users_by_id', 'users_by_login',
+                       'contacts', 'contacts_by_id', 'contacts_by_code',
+                       'projects', 'projects_by_id', 'projects_by_code')
+
+    def __init__(self, api_key=None, url_base=None, pool_size=8, debuglevel=0, cache=None, refresh=False,
+                 lazy=False, query_cache=None, partial_updates=False, retry=None, compression=True,
+                 transport=None, observers=None):
+        """Create a MinuteDock object. Can throw any file related
+        exception when attempting to obtain the API key.
+
+        api_key: The API key to use. Default is None which reads the key from '~/.md.key'.
+
+        url_base: Base URL of the API. Default is None which uses URL_BASE.
+
+        pool_size: Maximum number of idle keep-alive connections retained for reuse.
+
+        debuglevel: Passed to the underlying http.client connections.
+
+        cache: A ReferenceCache used to load and store the users, contacts and
+          projects. Default is None which always queries the API.
+
+        refresh: If True, ignore any cached reference data and query the API.
+
+        lazy: If True, the users, contacts and projects are not loaded until one
+          of them, or one of their lookup dictionaries, is first accessed.
+
+        query_cache: A QueryCache used to memoize entries_search results. Default
+          is None which disables caching.
+
+        partial_updates: If True, Entry.update sends only the changed fields rather
+          than the whole entry. Entry.update(force=True) always sends the whole entry.
+
+        retry: A RetryPolicy for failed requests and request pacing. Default is None
+          which uses RetryPolicy().
+
+        compression: If True, ask the server for gzip or deflate compressed responses.
+          Transfer totals are counted in the stats attribute, a TransferStats.
+
+        transport: An object used to send requests in place of a ConnectionPool,
+          such as an mdfake.FakeTransport. See ConnectionPool for the interface it
+          must provide. When given, url_base, pool_size and debuglevel are ignored.
+
+        observers: A list of callables, each called with a RequestEvent after
+          every request attempt, including retries, such as a RequestMetrics.
+          They are called from whichever thread made the request and must not
+          raise. More can be appended to the observers attribute later.
+        """
+        self.api_key = self._read_api_key(api_key)
+
+        if transport is not None:
+            self.pool = transport
+        else:
+            if url_base is None:
+                url_base = self.URL_BASE
+            # Loading the CA certificates is slow, so only do it if they will be used
+            ssl_context = self._ssl_context() if urllib.parse.urlsplit(url_base).scheme == 'https' else None
+            self.pool = ConnectionPool(url_base, ssl_context, maxsize=pool_size, debuglevel=debuglevel)
+        self.cache = cache
+        self.query_cache = query_cache
+        self.partial_updates = partial_updates
+        self.retry = retry if retry is not None else RetryPolicy()
+        self.compression = compression
+        self.stats = TransferStats()
+        self.observers = list(observers) if observers else []
+        self._refresh = refresh
+        self._load_lock = threading.Lock()
+
+        if not lazy:
+            self.load_reference_data(refresh)
+
+    def __getattr__(self, name):
+        # Only called for missing attributes, which for the reference data
+        # means it has not been loaded yet.
+        if name in self.REFERENCE_ATTRS and '_load_lock' in self.__dict__:
+            with self._load_lock:
+                if name not in self.__dict__:
+                    self.load_reference_data(self._refresh)
+            return self.__dict__[name]
+        raise AttributeError("%r object has no attribute %r" % (type(self).__name__, name))
+
+    def load_reference_data(self, refresh=False):
+        """(Re)load the users, contacts and projects. They are taken from the
+        cache if there is a fresh copy and refresh is False, otherwise they are
+        fetched concurrently from the API and the cache is updated."""
+        cached = None
+        if self.cache is not None and not refresh:
+            cached = self.cache.load(self.api_key, self.pool.url_base)
+
+        if cached is None:
+            # The three requests are independent, so issue them concurrently
+            # and build the indexes once all have completed.
+            with concurrent.futures.ThreadPoolExecutor(3) as executor:
+                cached = list(executor.map(self._do_get, ['users.json', 'contacts.json', 'projects.json']))
+            if self.cache is not None:
+                self.cache.store(self.api_key, self.pool.url_base, *cached)
+
+        self._set_reference_data(*cached)
+
+    def close(self):
+        """Close any idle connections held by the connection pool."""
+        self.pool.close()
+
+    def _open(self, method, req, args=None, body=None, headers=None, attempt=0):
+        """Internal function to send a request. Returns a (response, event) tuple
+        of the PooledResponse, with its body unread, and its RequestEvent.
+        Failed requests are retried as allowed by the retry policy, counting
+        from attempt. Raises urllib.error.HTTPError for error responses and,
+        as urllib.request.urlopen does, urllib.error.URLError for network
+        errors (such as a refused connection) once the retries are used up."""
+        url = self._url(req, args)
+        headers = self._request_headers(headers)
+        while True:
+            delay = self.retry.reserve()
+            if delay > 0:
+                time.sleep(delay)
+            event = RequestEvent(method, req, args, attempt)
+            try:
+                response = self.pool.request(method, url, body, headers)
+                event.response_received(response)
+                if response.status < 400:
+                    return (response, event)
+                try:
+                    data = response.read()
+                finally:
+                    response.close()
+                event.bytes_on_wire = len(data)
+                data = self._decode_body(response.headers, data)
+                event.bytes_decoded = len(data)
+            except self.retry.RETRY_ERRORS as e:
+                self._notify(event, e)
+                delay = self.retry.retry_delay(attempt)
+                if delay is None:
+                    raise _url_error(e)
+            except Exception as e:
+                self._notify(event, e)
+                raise _url_error(e)
+            else:
+                self._notify(event)
+                delay = self.retry.retry_delay(attempt, response.status, response.headers)
+                if delay is None:
+                    self._check_response(self.pool.url_base + url, response.status, response.reason,
+                                         response.headers, data)
+            time.sleep(delay)
+            attempt += 1
+
+    def _request(self, method, req, args=None, body=None, headers=None):
+        """Internal function to perform a request and return the decoded response body.
+        Failed requests are retried as allowed by the retry policy. Raises
+        urllib.error.HTTPError for error responses."""
+        attempt = 0
+        while True:
+            (response, event) = self._open(method, req, args, body, headers, attempt)
+            try:
+                try:
+                    data = response.read()
+                finally:
+                    response.close()
+                event.bytes_on_wire = len(data)
+                data = self._decode_body(response.headers, data)
+                event.bytes_decoded = len(data)
+            except self.retry.RETRY_ERRORS as e:
+                self._notify(event, e)
+                delay = self.retry.retry_delay(event.attempt)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                attempt = event.attempt + 1
+                continue
+            except Exception as e:
+                self._notify(event, e)
+                raise
+            self._notify(event)
+            return data
+
+    def _body_chunks(self, response, event=None, chunk_size=65536):
+        """Internal generator yielding the decoded body of response a chunk at
+        a time. The response is closed when the generator finishes, and the
+        byte counts are then recorded in event."""
+        encoding = (response.headers.get('Content-Encoding') or 'identity').strip().lower()
+        decompressor = None
+        if encoding in ('gzip', 'x-gzip'):
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif encoding != 'identity' and encoding != 'deflate':
+            response.close()
+            raise ValueError("Unsupported Content-Encoding: %r" % (encoding,))
+
+        (bytes_on_wire, bytes_decoded, decode_time) = (0, 0, 0.0)
+        try:
+            while True:
+                raw = response.read(chunk_size)
+                start = time.perf_counter()
+                bytes_on_wire += len(raw)
+                if encoding == 'deflate' and decompressor is None and raw:
+                    # A zlib header, or a raw deflate stream
+                    is_zlib = len(raw) >= 2 and (raw[0] & 0x0f) == 8 and ((raw[0] << 8) | raw[1]) % 31 == 0
+                    decompressor = zlib.decompressobj(zlib.MAX_WBITS if is_zlib else -zlib.MAX_WBITS)
+                data = raw
+                if decompressor is not None:
+                    data = decompressor.decompress(raw) if raw else decompressor.flush()
+                decode_time += time.perf_counter() - start
+                bytes_decoded += len(data)
+                if data:
+                    yield data
+                if not raw:
+                    break
+        finally:
+            response.close()
+            self.stats.record(bytes_on_wire, bytes_decoded, decode_time)
+            if event is not None:
+                event.bytes_on_wire = bytes_on_wire
+                event.bytes_decoded = bytes_decoded
+
+    def _stream_entries(self, search_dict):
+        """Internal generator yielding raw entries one at a time, across all
+        pages, as each is decoded from the response. A failure part way
+        through a page is retried from the offset of the next entry."""
+        offset = 0
+        attempt = 0
+        while True:
+            args = dict(search_dict)
+            args['offset'] = str(offset)
+            count = 0
+            (response, event) = self._open('GET', 'entries.json', args, attempt=attempt)
+            chunks = self._body_chunks(response, event)
+            try:
+                try:
+                    for e in iter_json_array(chunks):
+                        count += 1
+                        yield e
+                finally:
+                    chunks.close()
+            except self.retry.RETRY_ERRORS as e:
+                self._notify(event, e)
+                delay = self.retry.retry_delay(event.attempt)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                attempt = event.attempt + 1
+                offset += count
+                continue
+            except Exception as e:
+                self._notify(event, e)
+                raise
+            self._notify(event)
+            if count == 0:
+                break
+            offset += count
+            attempt = 0
+
+    def _do_get(self, req, args=None):
+        """Internal function to perform 'GET' requests."""
+        data = self._request('GET', req, args)
+        return json.loads(data.decode())
+
+    def _do_put(self, req, obj):
+        """Internal function to perform 'PUT' requests."""
+        upload_data = json.dumps(obj).encode()
+        self._request('PUT', req, body=upload_data, headers={'Content-Type': 'application/json'})
+
+    def _put_entry(self, entry, force=False):
+        """Internal function to update an entry on the server, if it has changed."""
+        payload = self._entry_payload(entry, force)
+        if payload is None:
+            return
+        self._do_put('entries/%s.json' % entry.entry_id, payload)
+        self._entry_updated(entry)
+
+    def _get_page(self, search_dict, offset):
+        """Internal function to fetch the page of entries at offset."""
+        args = dict(search_dict)
+        args['offset'] = str(offset)
+        return self._do_get('entries.json', args)
+
+    def _fetch_entries(self, search_dict, workers=1):
+        """Internal function that pages through 'entries.json' and returns the
+        raw entries in order.
+
+        The server pages by offset and a search ends with the first empty
+        page. When workers is greater than one the size of the first page is
+        used to speculatively request the following pages, keeping up to
+        workers requests in flight. As soon as a page comes back short the
+        speculative results are dropped and the remainder is fetched serially,
+        so the result is always identical to a serial walk.
+        """
+        entries = []
+        offset = 0
+        page = self._get_page(search_dict, offset)
+
+        if workers > 1 and len(page) > 0:
+            page_size = len(page)
+            with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+                pending = collections.deque(
+                    [executor.submit(self._get_page, search_dict, page_size * (i + 1)) for i in range(workers)])
+                while len(page) == page_size:
+                    entries += page
+                    offset += page_size
+                    page = pending.popleft().result()
+                    pending.append(executor.submit(self._get_page, search_dict,
+                                                   offset + page_size * (len(pending) + 1)))
+                for f in pending:
+                    f.cancel()
+
+        while len(page) > 0:
+            entries += page
+            offset += len(page)
+            page = self._get_page(search_dict, offset)
 
         return entries
+
+    def _fetch_sharded(self, search_dict, date_range, shard, workers=1):
+        """Internal function that splits date_range into shards, fetches each
+        shard as an independent search, and merges the results. Entries are
+        returned in shard order with duplicates (by id) removed."""
+        shard_dicts = self._shard_dicts(search_dict, date_range, shard)
+        with concurrent.futures.ThreadPoolExecutor(max(workers, 1)) as executor:
+            results = list(executor.map(self._fetch_entries, shard_dicts))
+        return self._merge_shards(results)
+
+    def entries_search(self, date_range=None, user_logins=None, contacts=None, projects=None, workers=1,
+                       shard=None, as_table=False):
+        """Search for entries that match the search criteria.
+
+        date_range: A tuple of datetime.date object to restrict the search. Default is None
+          which represents current week.
+
+        user_logins: List of user logins to restrict search by. Default is None which
+          represents all users.
+
+        contacts: List of contact short codes to restrict search by. Default is None which
+          represents all contacts.
+
+        projects: List of project short codes to restict search by. Default is None which
+          represents all contacts. If list is empty return entries with no project set.
+
+        workers: Number of page requests to keep in flight at once. Default is 1 which
+          fetches one page at a time. The result does not depend on this value.
+
+        shard: Either 'week' or 'month' to split date_range into per-week or per-month
+          queries which are fetched in parallel, up to workers at a time, and merged.
+          Default is None which sends date_range as a single query.
+
+        as_table: If True return an mdtable.EntryTable rather than a list of Entry objects.
+        """
+        if shard is not None and date_range is None:
+            raise ValueError("A date_range is required for a sharded search")
+
+        search_dict = self._search_dict(date_range, user_logins, contacts, projects)
+
+        if shard is None and workers <= 1 and self.query_cache is None:
+            # Nothing needs the whole raw list, so consume it as it is decoded.
+            entries = self._stream_entries(search_dict)
+            return self._make_result(entries, projects, as_table)
+
+        entries = None
+        if self.query_cache is not None:
+            entries = self.query_cache.get(self.api_key, self.pool.url_base, search_dict)
+
+        if entries is None:
+            if shard is None:
+                entries = self._fetch_entries(search_dict, workers)
+            else:
+                entries = self._fetch_sharded(search_dict, date_range, shard, workers)
+            if self.query_cache is not None:
+                self.query_cache.put(self.api_key, self.pool.url_base, search_dict, entries)
+
+        return self._make_result(entries, projects, as_table)
+
+    def _update_one(self, entry, limiter):
+        """Internal function to update one entry for update_many."""
+        if not entry.is_dirty:
+            return UpdateResult(entry, None)
+        if limiter is not None:
+            limiter.acquire()
+        try:
+            entry.update()
+        except Exception as e:
+            return UpdateResult(entry, e)
+        return UpdateResult(entry, None)
+
+    def update_many(self, entries, workers=4, rate=None):
+        """Update the backend copy of each of entries, with up to workers PUT
+        requests in flight.
+
+        Rate limited and otherwise failed requests are retried according to
+        the retry policy. If rate is given, these updates are additionally
+        limited to that many per second across all workers.
+
+        Returns a list of UpdateResult(entry, error) tuples in the same order
+        as entries, where error is None if the update succeeded or the
+        exception that made it fail. Entries that have not been changed are
+        not sent and succeed trivially.
+        """
+        limiter = TokenBucket(rate) if rate else None
+        with concurrent.futures.ThreadPoolExecutor(max(workers, 1)) as executor:
+            return list(executor.map(lambda e: self._update_one(e, limiter), entries))
+
+    def entries_iter(self, date_range=None, user_logins=None, contacts=None, projects=None):
+        """A generator version of entries_search. Each Entry object is yielded as
+        soon as it has been decoded from the response, so neither a whole page
+        nor its raw JSON is held in memory. Arguments are as for entries_search."""
+        search_dict = self._search_dict(date_range, user_logins, contacts, projects)
+        for e in self._filter_raw(self._stream_entries(search_dict), projects):
+            yield Entry(self, e)
@@ -0,0 +1,163 @@
+"""
+Grouping and aggregation of MinuteDock entries.
+
+Entries can be grouped by 'user', 'contact', 'project', 'day', 'week' or
+'month', by any other Entry attribute name, by a function of an entry, or
+by a tuple of these. Grouping is a single linear pass:
+
+    totals = aggregate(entries, 'user')
+    for (user_id, a) in totals.items():
+        print(md.users_by_id[user_id], a.count, a.total / 3600.0)
+
+aggregate only keeps running totals per group; group_by is available for
+when the grouped entries themselves are needed. Both also accept an
+mdtable.EntryTable. aggregate then works on its columns without creating
+Entry objects, unless the key is a function (or an attribute that has no
+column), which is called with an Entry for each row.
+
+Several aggregations of the same entries can be declared as Reports and
+computed together in one pass, for example over a streamed search:
+
+    results = run_reports(md.entries_iter(date_range=...),
+                          {'by_user': Report('user'),
+                           'by_contact': Report('contact'),
+                           'by_project': Report('project', where=lambda e: not e.timer_active)})
+    results['by_user']  # as returned by aggregate(entries, 'user')
+"""
+
+import collections
+import operator
+
+from md import period_start
+from mdtable import EntryTable, NO_PROJECT
+
+KEY_ATTRS = {'user': 'user_id', 'contact': 'contact_id', 'project': 'project_id'}
+PERIODS = ('day', 'week', 'month')
+
+def _period_key(period):
+    def key(e):
+        return period_start(e.date.date(), period)
+    return key
+
+def key_func(key):
+    """Return a function computing the grouping key of an Entry. See the module
+    documentation for the possible values of key."""
+    if callable(key):
+        return key
+    if isinstance(key, tuple):
+        funcs = [key_func(k) for k in key]
+        return lambda e: tuple([f(e) for f in funcs])
+    if key in PERIODS:
+        return _period_key(key)
+    return operator.attrgetter(KEY_ATTRS.get(key, key))
+
+TABLE_COLUMNS = frozenset(EntryTable.INT_COLUMNS + EntryTable.PERIODS + ('timer_active',))
+
+def _table_keys(table, key):
+    """Return the list of grouping keys for the rows of an EntryTable, the
+    same as key_func(key) gives for the corresponding Entry objects."""
+    if isinstance(key, tuple):
+        return list(zip(*[_table_keys(table, k) for k in key]))
+    if not callable(key):
+        name = KEY_ATTRS.get(key, key)
+        if name == 'project_id':
+            return [None if p == NO_PROJECT else p for p in table.project_id]
+        if name == 'description':
+            return table.column('descriptions')
+        if name in TABLE_COLUMNS:
+            return table.column(name)
+    f = key_func(key)
+    return [f(table.entry(i)) for i in range(len(table))]
+
+class Aggregate(object):
+    """Running count, total, min and max of a value (normally 'duration')."""
+
+    __slots__ = ('count', 'total', 'min', 'max')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def __repr__(self):
+        return "<Aggregate count=%d total=%s min=%s max=%s>" % (self.count, self.total, self.min, self.max)
+
+def _pairs(entries, key, value):
+    """Return an iterable of (key, value) pairs for Entry objects or an EntryTable."""
+    if isinstance(entries, EntryTable):
+        return zip(_table_keys(entries, key), entries.column(value))
+    (f, g) = (key_func(key), operator.attrgetter(value))
+    return ((f(e), g(e)) for e in entries)
+
+def aggregate(entries, key, value='duration'):
+    """Return an ordered dictionary mapping each group key to an Aggregate of
+    value over the entries in that group, in order of first appearance."""
+    groups = collections.OrderedDict()
+    for (k, v) in _pairs(entries, key, value):
+        a = groups.get(k)
+        if a is None:
+            a = groups[k] = Aggregate()
+        a.add(v)
+    return groups
+
+def group_by(entries, key):
+    """Return an ordered dictionary mapping each group key to the list of
+    Entry objects in that group, in order of first appearance."""
+    groups = collections.OrderedDict()
+    if isinstance(entries, EntryTable):
+        pairs = ((k, entries.entry(i)) for (i, k) in enumerate(_table_keys(entries, key)))
+    else:
+        f = key_func(key)
+        pairs = ((f(e), e) for e in entries)
+    for (k, e) in pairs:
+        group = groups.get(k)
+        if group is None:
+            group = groups[k] = []
+        group.append(e)
+    return groups
+
+class Report(object):
+    """The specification of one aggregation for run_reports: group by key,
+    aggregate value, optionally counting only the entries for which
+    where(entry) is true."""
+
+    def __init__(self, key, value='duration', where=None):
+        self.key = key
+        self.value = value
+        self.where = where
+
+def run_reports(entries, reports):
+    """Compute several aggregations in a single pass over entries, which may
+    be any iterable of Entry objects (such as MinuteDock.entries_iter).
+
+    reports is a dictionary mapping a name to a Report, or to a key, which is
+    short for Report(key). Returns a dictionary mapping each name to the
+    result of the corresponding aggregate call."""
+    specs = []
+    results = {}
+    for (name, report) in reports.items():
+        if not isinstance(report, Report):
+            report = Report(report)
+        groups = results[name] = collections.OrderedDict()
+        specs.append((key_func(report.key), operator.attrgetter(report.value), report.where, groups))
+
+    for e in entries:
+        for (f, g, where, groups) in specs:
+            if where is not None and not where(e):
+                continue
+            k = f(e)
+            a = groups.get(k)
+            if a is None:
+                a = groups[k] = Aggregate()
+            a.add(g(e))
+
+    return results
@@ -0,0 +1,446 @@
+"""
+A fake MinuteDock API, for testing and benchmarking without network access
+or an account.
+
+A Dataset generates users, contacts, projects and any number of entries.
+FakeAPI answers requests against it the way the MinuteDock API does:
+users.json, contacts.json, projects.json, paginated entries.json searches
+(users, contacts, projects, from, to and offset arguments) and PUTs to
+entries/<id>.json. It can be served over HTTP on a local port:
+
+    with FakeServer(FakeAPI(Dataset(entries=100000))) as server:
+        md = MinuteDock(api_key='fake', url_base=server.url_base)
+
+or in-process, with no sockets at all, as a MinuteDock transport:
+
+    md = MinuteDock(api_key='fake', transport=FakeTransport(FakeAPI(Dataset(entries=1000))))
+
+Latency and error responses are injected with Faults:
+
+    api = FakeAPI(dataset, faults=Faults(latency=0.05, error_rate=0.01, statuses=(503, 429)))
+
+Run as a script to serve a dataset on a local port until interrupted:
+
+    python mdfake.py --entries 100000 --port 8080
+"""
+
+import argparse
+import array
+import bisect
+import collections
+import datetime
+import gzip
+import http.client
+import http.server
+import io
+import json
+import random
+import socketserver
+import sys
+import threading
+import time
+import urllib.parse
+
+from md import Entry, format_logged_at, parse_logged_at
+
+API_PATH = '/api/v1'
+
+NO_PROJECT = 0
+
+VERBS = ['Meeting', 'Call', 'Design', 'Review', 'Development', 'Testing', 'Support', 'Planning',
+         'Documentation', 'Travel', 'Debugging', 'Deployment']
+SUBJECTS = ['requirements', 'prototype', 'release', 'invoices', 'board', 'firmware', 'website',
+            'database', 'network', 'proposal', 'training', 'hardware']
+
+class Dataset(object):
+    """Generated MinuteDock data. Entries are evenly spread over the given
+    number of days from start and are held as columns, so that millions of
+    them fit comfortably in memory; entry dictionaries are only created for
+    the pages actually served. The same seed always generates the same data."""
+
+    def __init__(self, entries=1000, users=10, contacts=20, projects=50, start=datetime.date(2012, 1, 1),
+                 days=365, utc_offset='+10:00', seed=0):
+        rng = random.Random(seed)
+        self.start = datetime.datetime.combine(start, datetime.time())
+        self.tz = parse_logged_at('2000-01-01T00:00:00' + utc_offset).tzinfo
+        self.utc_offset = utc_offset
+
+        self.users = [{'id': i, 'email': 'user%d@example.com' % i, 'first_name': 'User',
+                       'last_name': str(i)} for i in range(1, users + 1)]
+        self.contacts = [{'id': i, 'name': 'Contact %d' % i, 'short_code': 'C%d' % i,
+                          'default_rate_dollars': rng.choice([100, 120, 150])} for i in range(1, contacts + 1)]
+        self.projects = [{'id': i, 'contact_id': rng.randint(1, contacts), 'name': 'Project %d' % i,
+                          'short_code': 'P%d' % i, 'description': '', 'default_rate_dollars': 120}
+                         for i in range(1, projects + 1)]
+        self.descriptions = ['%s: %s' % (v, s) for v in VERBS for s in SUBJECTS]
+
+        # Column i describes the entry with id i + 1
+        self.user_id = array.array('l')
+        self.contact_id = array.array('l')
+        self.project_id = array.array('l')
+        self.duration = array.array('l')
+        self.description = array.array('l')
+        self.logged_at = array.array('q')
+        project_contacts = [p['contact_id'] for p in self.projects]
+        span = days * 86400
+        for i in range(entries):
+            project = rng.randint(0, projects)
+            self.user_id.append(rng.randint(1, users))
+            self.contact_id.append(project_contacts[project - 1] if project else rng.randint(1, contacts))
+            self.project_id.append(project)
+            self.duration.append(rng.randint(1, 480) * 60)
+            self.description.append(rng.randrange(len(self.descriptions)))
+            self.logged_at.append(i * span // max(entries, 1))
+
+        self._overrides = {}
+        # Local times, like logged_at, of the entries moved by a PUT. The
+        # logged_at column keeps the generated times so it stays sorted.
+        self._moved = {}
+        self._searches = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.logged_at)
+
+    def raw_entry(self, i):
+        """Return the raw entry dictionary for the entry at index i."""
+        raw = self._overrides.get(i)
+        if raw is not None:
+            return dict(raw)
+        date = (self.start + datetime.timedelta(seconds=self.logged_at[i])).replace(tzinfo=self.tz)
+        project_id = self.project_id[i]
+        return {'id': i + 1, 'user_id': self.user_id[i], 'contact_id': self.contact_id[i],
+                'project_id': project_id if project_id != NO_PROJECT else None,
+                'duration': self.duration[i], 'description': self.descriptions[self.description[i]],
+                'timer_active': i == len(self) - 1, 'logged_at': format_logged_at(date)}
+
+    def _date_seconds(self, value, after):
+        """Return the start of the date value (a 'mm/dd/yyyy' string), or of
+        the following day if after is True, in the units of logged_at."""
+        date = datetime.datetime.strptime(value, '%m/%d/%Y')
+        if after:
+            date += datetime.timedelta(days=1)
+        return int((date - self.start).total_seconds())
+
+    def _local_seconds(self, logged_at):
+        """Return the local time of a 'logged_at' string in the units of the
+        logged_at column, so an entry is searched by its own local date."""
+        date = parse_logged_at(logged_at).replace(tzinfo=None)
+        return int((date - self.start).total_seconds())
+
+    def search(self, query):
+        """Return an array of the indices of the entries matching the
+        'entries.json' arguments in query, in logged_at order."""
+        key = tuple([query.get(k) for k in ('users', 'contacts', 'projects', 'from', 'to')])
+        with self._lock:
+            result = self._searches.get(key)
+            if result is not None:
+                self._searches.move_to_end(key)
+                return result
+
+        low = self._date_seconds(query['from'], False) if 'from' in query else None
+        high = self._date_seconds(query['to'], True) if 'to' in query else None
+        first = bisect.bisect_left(self.logged_at, low) if low is not None else 0
+        last = bisect.bisect_left(self.logged_at, high) if high is not None else len(self)
+        with self._lock:
+            moved = dict(self._moved)
+        if not moved:
+            result = array.array('l', range(first, max(first, last)))
+        else:
+            # Moved entries are found by their new time, in logged_at order
+            indices = [i for i in range(first, last) if i not in moved]
+            indices += [i for (i, t) in moved.items()
+                        if (low is None or t >= low) and (high is None or t < high)]
+            indices.sort(key=lambda i: (moved.get(i, self.logged_at[i]), i))
+            result = array.array('l', indices)
+        for (name, column) in (('users', self.user_id), ('contacts', self.contact_id),
+                               ('projects', self.project_id)):
+            value = query.get(name, 'all')
+            if value in ('all', ''):
+                continue
+            ids = set([int(x) for x in value.split(',')])
+            result = array.array('l', [i for i in result if column[i] in ids])
+
+        with self._lock:
+            self._searches[key] = result
+            if len(self._searches) > 64:
+                self._searches.popitem(last=False)
+        return result
+
+    def update_entry(self, entry_id, fields):
+        """Apply the fields of a PUT to the entry with entry_id. Returns the
+        updated raw entry, or None if there is no such entry."""
+        i = entry_id - 1
+        if not 0 <= i < len(self):
+            return None
+        with self._lock:
+            raw = self.raw_entry(i)
+            for (k, v) in fields.items():
+                if k in Entry.FIELDS and k != 'id':
+                    raw[k] = v
+            self._overrides[i] = raw
+            self.user_id[i] = raw['user_id']
+            self.contact_id[i] = raw['contact_id']
+            self.project_id[i] = raw['project_id'] if raw['project_id'] is not None else NO_PROJECT
+            if 'logged_at' in fields:
+                self._moved[i] = self._local_seconds(raw['logged_at'])
+            self._searches.clear()
+        return dict(raw)
+
+class Faults(object):
+    """Latency and errors to inject into every request handled by a FakeAPI.
+
+    latency: Seconds to wait before answering each request, plus a uniformly
+      random extra of up to jitter seconds.
+
+    error_rate: The probability of answering a request with an error status,
+      chosen at random from statuses, instead of handling it. When retry_after
+      is not None it is sent as the Retry-After header of these responses.
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, statuses=(503,), retry_after=None, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.statuses = statuses
+        self.retry_after = retry_after
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def delay(self):
+        """Return the number of seconds to delay a response by."""
+        if not self.jitter:
+            return self.latency
+        with self._lock:
+            return self.latency + self._random.uniform(0, self.jitter)
+
+    def error(self):
+        """Return an error status to answer a request with, or None."""
+        if not self.error_rate:
+            return None
+        with self._lock:
+            if self._random.random() < self.error_rate:
+                return self._random.choice(self.statuses)
+        return None
+
+class FakeAPI(object):
+    """Answers MinuteDock API requests from a Dataset. entries.json returns
+    page_size entries per page. If api_key is not None, requests with any
+    other key are refused. Responses are gzip compressed when the client
+    accepts it, unless compression is False.
+
+    The number of requests handled is counted per (method, endpoint) in the
+    requests attribute, a collections.Counter."""
+
+    def __init__(self, dataset=None, page_size=50, faults=None, api_key=None, compression=True):
+        self.dataset = dataset if dataset is not None else Dataset()
+        self.page_size = page_size
+        self.faults = faults
+        self.api_key = api_key
+        self.compression = compression
+        self.requests = collections.Counter()
+        self._lock = threading.Lock()
+
+    def handle(self, method, path, headers=None, body=None):
+        """Handle a request for path (including the '/api/v1' prefix and the
+        query string). Returns a (status, headers, body) tuple."""
+        parts = urllib.parse.urlsplit(path)
+        query = dict(urllib.parse.parse_qsl(parts.query, keep_blank_values=True))
+        endpoint = parts.path[len(API_PATH) + 1:] if parts.path.startswith(API_PATH + '/') else parts.path
+        with self._lock:
+            self.requests[(method, endpoint)] += 1
+
+        if self.faults is not None:
+            delay = self.faults.delay()
+            if delay > 0:
+                time.sleep(delay)
+            status = self.faults.error()
+            if status is not None:
+                extra = {}
+                if self.faults.retry_after is not None:
+                    extra['Retry-After'] = str(self.faults.retry_after)
+                return self._error(status, 'Injected error', extra)
+
+        if self.api_key is not None and query.get('api_key') != self.api_key:
+            return self._error(401, 'Invalid API key')
+
+        if method == 'GET':
+            (status, obj) = self._get(endpoint, query)
+        elif method == 'PUT':
+            (status, obj) = self._put(endpoint, body)
+        else:
+            (status, obj) = (405, None)
+        if obj is None:
+            return self._error(status, http.client.responses.get(status, 'Error'))
+
+        data = json.dumps(obj).encode()
+        response_headers = {'Content-Type': 'application/json; charset=utf-8'}
+        accept = (headers or {}).get('Accept-Encoding') or ''
+        if self.compression and 'gzip' in accept:
+            data = gzip.compress(data, compresslevel=6)
+            response_headers['Content-Encoding'] = 'gzip'
+        return (status, response_headers, data)
+
+    def _get(self, endpoint, query):
+        dataset = self.dataset
+        if endpoint == 'users.json':
+            return (200, dataset.users)
+        if endpoint == 'contacts.json':
+            return (200, dataset.contacts)
+        if endpoint == 'projects.json':
+            return (200, dataset.projects)
+        if endpoint == 'entries.json':
+            try:
+                indices = dataset.search(query)
+                offset = int(query.get('offset', 0))
+            except ValueError:
+                return (400, None)
+            return (200, [dataset.raw_entry(i) for i in indices[offset:offset + self.page_size]])
+        return (404, None)
+
+    def _put(self, endpoint, body):
+        if not (endpoint.startswith('entries/') and endpoint.endswith('.json')):
+            return (404, None)
+        try:
+            entry_id = int(endpoint[len('entries/'):-len('.json')])
+            fields = json.loads(body.decode())['entry']
+        except (ValueError, KeyError, TypeError, AttributeError):
+            return (400, None)
+        raw = self.dataset.update_entry(entry_id, fields)
+        return (404, None) if raw is None else (200, raw)
+
+    def _error(self, status, message, headers=None):
+        response_headers = {'Content-Type': 'application/json; charset=utf-8'}
+        if headers:
+            response_headers.update(headers)
+        return (status, response_headers, json.dumps({'error': message}).encode())
+
+class _Handler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def _handle(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else None
+        (status, headers, data) = self.server.api.handle(self.command, self.path, self.headers, body)
+        self.send_response(status)
+        for item in headers.items():
+            self.send_header(*item)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    do_GET = do_PUT = do_POST = do_DELETE = _handle
+
+class _HTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients dropping idle keep-alive connections are not errors
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            http.server.HTTPServer.handle_error(self, request, client_address)
+
+class FakeServer(object):
+    """Serves a FakeAPI over HTTP on host and port (by default, a free port on
+    the loopback interface) from a background thread. The API's base URL,
+    to pass to MinuteDock as url_base, is in the url_base attribute once
+    started. Can be used as a context manager."""
+
+    def __init__(self, api=None, host='127.0.0.1', port=0):
+        self.api = api if api is not None else FakeAPI()
+        self.host = host
+        self.port = port
+        self.url_base = None
+        self._server = None
+        self._thread = None
+
+    def start(self):
+        self._server = _HTTPServer((self.host, self.port), _Handler)
+        self._server.api = self.api
+        (host, port) = self._server.server_address[:2]
+        self.url_base = 'http://%s:%d%s' % (host, port, API_PATH)
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._thread.join()
+            self._server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+class FakeResponse(object):
+    """A response from a FakeTransport, with the same interface as md.PooledResponse."""
+
+    def __init__(self, status, headers, body):
+        self.status = status
+        self.reason = http.client.responses.get(status, '')
+        self.headers = http.client.HTTPMessage()
+        for item in headers.items():
+            self.headers[item[0]] = item[1]
+        self._body = io.BytesIO(body)
+
+    def getheader(self, name, default=None):
+        return self.headers.get(name, default)
+
+    def read(self, amt=None):
+        return self._body.read(amt)
+
+    def close(self):
+        pass
+
+class FakeTransport(object):
+    """A MinuteDock transport (see md.ConnectionPool) that passes requests
+    directly to a FakeAPI in the same process, avoiding sockets and HTTP
+    parsing altogether."""
+
+    def __init__(self, api=None, url_base='http://minutedock.invalid' + API_PATH):
+        self.api = api if api is not None else FakeAPI()
+        self.url_base = url_base
+        self.path = urllib.parse.urlsplit(url_base).path.rstrip('/')
+
+    def request(self, method, url, body=None, headers=None):
+        (status, response_headers, data) = self.api.handle(method, self.path + url, headers, body)
+        return FakeResponse(status, response_headers, data)
+
+    def close(self):
+        pass
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve a fake MinuteDock API.')
+    parser.add_argument('--entries', type=int, default=1000, help='number of entries to generate')
+    parser.add_argument('--users', type=int, default=10)
+    parser.add_argument('--contacts', type=int, default=20)
+    parser.add_argument('--projects', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--page-size', type=int, default=50)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds to delay each response')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of requests answered with 503')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    args = parser.parse_args()
+
+    dataset = Dataset(entries=args.entries, users=args.users, contacts=args.contacts, projects=args.projects,
+                      seed=args.seed)
+    faults = None
+    if args.latency or args.error_rate:
+        faults = Faults(latency=args.latency, error_rate=args.error_rate)
+    server = FakeServer(FakeAPI(dataset, args.page_size, faults), args.host, args.port).start()
+    print("Serving %d entries at %s" % (len(dataset), server.url_base))
+    try:
+        server._thread.join()
+    except KeyboardInterrupt:
+        server.stop()
+
+if __name__ == "__main__":
+    main()
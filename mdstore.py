@@ -0,0 +1,150 @@
+"""
+A local SQLite mirror of MinuteDock entries.
+
+An EntryStore keeps a copy of every entry in a set of date windows
+(calendar months by default) and answers searches from an indexed local
+table instead of paging through the API:
+
+    md = MinuteDock()
+    store = EntryStore(md, 'entries.db')
+    store.sync((datetime.date(2012, 7, 1), datetime.date(2012, 7, 31)))
+    entries = store.entries_search(date_range=(datetime.date(2012, 7, 1), datetime.date(2012, 7, 31)),
+                                   projects=['SOMEPROJECT'])
+
+sync only fetches windows that have never been synced, or that were last
+synced before they had finished (plus a settling period), so repeated runs
+over historical months make no API requests at all.
+"""
+
+import concurrent.futures
+import datetime
+import json
+import sqlite3
+import time
+
+from md import Entry, date_shards
+
+class EntryStore(object):
+    """A local store of raw entries for the MinuteDock object md, kept in the
+    SQLite database at path."""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS entries (
+            id INTEGER PRIMARY KEY,
+            user_id INTEGER,
+            contact_id INTEGER,
+            project_id INTEGER,
+            logged_on TEXT,
+            logged_at TEXT,
+            raw TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS entries_logged_on ON entries (logged_on);
+        CREATE INDEX IF NOT EXISTS entries_user_id ON entries (user_id, logged_on);
+        CREATE INDEX IF NOT EXISTS entries_contact_id ON entries (contact_id, logged_on);
+        CREATE INDEX IF NOT EXISTS entries_project_id ON entries (project_id, logged_on);
+        CREATE TABLE IF NOT EXISTS windows (
+            start TEXT NOT NULL,
+            end TEXT NOT NULL,
+            synced_at REAL NOT NULL,
+            PRIMARY KEY (start, end)
+        );
+    """
+
+    def __init__(self, md, path, period='month', settle_days=7):
+        """Create an EntryStore.
+
+        period: The sync window size, either 'week' or 'month'.
+
+        settle_days: A window is considered final, and is not fetched again,
+          once it has been synced more than this many days after it ended.
+        """
+        self.md = md
+        self.path = path
+        self.period = period
+        self.settle_days = settle_days
+        self.db = sqlite3.connect(path)
+        self.db.executescript(self.SCHEMA)
+
+    def close(self):
+        self.db.close()
+
+    def _is_final(self, window, synced_at, max_age):
+        (_from, _to) = window
+        if max_age is not None and time.time() - synced_at > max_age:
+            return False
+        synced_on = datetime.date.fromtimestamp(synced_at)
+        return synced_on > _to + datetime.timedelta(days=self.settle_days)
+
+    def stale_windows(self, date_range, max_age=None):
+        """Return the windows of date_range that sync would fetch: those never
+        synced, those synced before they were final and, if max_age is given,
+        those last synced more than max_age seconds ago."""
+        stale = []
+        for window in date_shards(date_range, self.period):
+            row = self.db.execute("SELECT synced_at FROM windows WHERE start = ? AND end = ?",
+                                  (window[0].isoformat(), window[1].isoformat())).fetchone()
+            if row is None or not self._is_final(window, row[0], max_age):
+                stale.append(window)
+        return stale
+
+    def sync(self, date_range, max_age=None, force=False, workers=1):
+        """Bring the store up to date for date_range, a tuple of datetime.date
+        objects. Only stale windows (see stale_windows) are fetched, unless
+        force is True in which case all windows are. Up to workers windows are
+        fetched in parallel. Returns the list of windows that were fetched."""
+        if force:
+            windows = date_shards(date_range, self.period)
+        else:
+            windows = self.stale_windows(date_range, max_age)
+
+        search_dicts = [self.md._search_dict(window) for window in windows]
+        synced_at = time.time()
+        with concurrent.futures.ThreadPoolExecutor(max(workers, 1)) as executor:
+            results = executor.map(self.md._fetch_entries, search_dicts)
+            for (window, raw_entries) in zip(windows, results):
+                self._replace_window(window, raw_entries, synced_at)
+
+        return windows
+
+    def _replace_window(self, window, raw_entries, synced_at):
+        (start, end) = (window[0].isoformat(), window[1].isoformat())
+        with self.db:
+            self.db.execute("DELETE FROM entries WHERE logged_on BETWEEN ? AND ?", (start, end))
+            self.db.executemany("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                [(e['id'], e['user_id'], e['contact_id'], e['project_id'],
+                                  e['logged_at'][:10], e['logged_at'], json.dumps(e))
+                                 for e in raw_entries])
+            self.db.execute("INSERT OR REPLACE INTO windows VALUES (?, ?, ?)", (start, end, synced_at))
+
+    def entries_search(self, date_range=None, user_logins=None, contacts=None, projects=None):
+        """Search the store for entries. Arguments are as for
+        MinuteDock.entries_search, except that a date_range of None means all
+        stored entries. Entries are returned in logged_at order."""
+        clauses = []
+        params = []
+
+        if date_range is not None:
+            clauses.append("logged_on BETWEEN ? AND ?")
+            params += [date_range[0].isoformat(), date_range[1].isoformat()]
+
+        for (column, values) in (('user_id', user_logins and [self.md.users_by_login[l].user_id
+                                                               for l in user_logins]),
+                                 ('contact_id', contacts and [self.md.contacts_by_code[c].contact_id
+                                                              for c in contacts]),
+                                 ('project_id', projects and [self.md.projects_by_code[p].project_id
+                                                              for p in projects])):
+            if values:
+                clauses.append("%s IN (%s)" % (column, ','.join('?' * len(values))))
+                params += values
+
+        # Same as MinuteDock.entries_search: an empty list of projects selects
+        # entries with no project set.
+        if projects is not None and len(projects) == 0:
+            clauses.append("project_id IS NULL")
+
+        query = "SELECT raw FROM entries"
+        if clauses:
+            query += " WHERE " + " AND ".join(clauses)
+        query += " ORDER BY logged_at, id"
+
+        return [Entry(self.md, json.loads(row[0])) for row in self.db.execute(query, params)]
@@ -0,0 +1,236 @@
+"""
+A columnar representation of MinuteDock entries.
+
+An EntryTable holds search results as parallel typed arrays (from the
+array module) instead of a list of Entry objects:
+
+- entry_id, user_id, contact_id, project_id, duration: 64-bit integers.
+  A project_id of NO_PROJECT means no project is set.
+- logged_at: seconds since the epoch (UTC).
+- utc_offset: the UTC offset, in seconds, 'logged_at' was recorded with.
+- timer_active: a bytearray with one 0/1 flag per entry.
+- description: indices into the 'strings' pool, so repeated descriptions
+  are stored once.
+
+Tables are obtained with MinuteDock.entries_search(as_table=True). Filtering
+uses masks (bytearrays of 0/1 flags, one per row), and sorting and group-by
+work over whole columns without creating Entry objects:
+
+    table = md.entries_search(date_range=..., as_table=True)
+    table = table.filter(table.mask_not(table.timer_active))
+    totals = table.group_sum(('user_id', 'day'))
+
+The columns support the buffer protocol, so when NumPy is available
+to_numpy returns zero-copy array views of them.
+"""
+
+import array
+import datetime
+
+from md import Entry, format_logged_at, parse_logged_at, period_start
+
+NO_PROJECT = -1
+
+_EPOCH_ORDINAL = datetime.date(1970, 1, 1).toordinal()
+
+def _logged_at_seconds(value):
+    """Return a (seconds since epoch, UTC offset in seconds) tuple for a 'logged_at' string."""
+    if len(value) == 25 and value[10] == 'T' and value[22] == ':':
+        offset = int(value[20:22]) * 3600 + int(value[23:25]) * 60
+        if value[19] == '-':
+            offset = -offset
+        days = datetime.date(int(value[0:4]), int(value[5:7]), int(value[8:10])).toordinal() - _EPOCH_ORDINAL
+        local = days * 86400 + int(value[11:13]) * 3600 + int(value[14:16]) * 60 + int(value[17:19])
+        return (local - offset, offset)
+    date = parse_logged_at(value)
+    offset = date.utcoffset()
+    offset = offset.days * 86400 + offset.seconds
+    local = (date.replace(tzinfo=None) - datetime.datetime(1970, 1, 1))
+    return (local.days * 86400 + local.seconds - offset, offset)
+
+class EntryTable(object):
+    """A table of entries stored column by column. See the module documentation."""
+
+    INT_COLUMNS = ('entry_id', 'user_id', 'contact_id', 'project_id', 'duration', 'logged_at', 'utc_offset')
+    PERIODS = ('day', 'week', 'month')
+
+    def __init__(self, md=None):
+        """Create an empty EntryTable. md is the MinuteDock object the entries
+        belong to; it is only needed to create Entry objects from rows."""
+        self.md = md
+        for name in self.INT_COLUMNS:
+            setattr(self, name, array.array('q'))
+        self.timer_active = bytearray()
+        self.description = array.array('l')
+        self.strings = []
+        self._string_index = {}
+
+    @classmethod
+    def from_raw(cls, md, raw_entries):
+        """Create an EntryTable from an iterable of raw entry dictionaries."""
+        table = cls(md)
+        table.extend_raw(raw_entries)
+        return table
+
+    def extend_raw(self, raw_entries):
+        """Append rows for an iterable of raw entry dictionaries."""
+        string_index = self._string_index
+        for e in raw_entries:
+            (logged_at, utc_offset) = _logged_at_seconds(e['logged_at'])
+            description = e['description']
+            i = string_index.get(description)
+            if i is None:
+                i = string_index[description] = len(self.strings)
+                self.strings.append(description)
+
+            self.entry_id.append(e['id'])
+            self.user_id.append(e['user_id'])
+            self.contact_id.append(e['contact_id'])
+            project_id = e['project_id']
+            self.project_id.append(NO_PROJECT if project_id is None else project_id)
+            self.duration.append(e['duration'])
+            self.logged_at.append(logged_at)
+            self.utc_offset.append(utc_offset)
+            self.timer_active.append(1 if e['timer_active'] else 0)
+            self.description.append(i)
+
+    def __len__(self):
+        return len(self.entry_id)
+
+    def column(self, name):
+        """Return a column by name. As well as the stored columns, 'day', 'week'
+        and 'month' give the local date (as a datetime.date) of each entry, or
+        the first day of its week or month, and 'descriptions' gives the
+        description strings."""
+        if name in self.PERIODS:
+            return self._period_column(name)
+        if name == 'descriptions':
+            strings = self.strings
+            return [strings[i] for i in self.description]
+        return getattr(self, name)
+
+    def _period_column(self, period):
+        dates = {}
+        column = []
+        for (t, offset) in zip(self.logged_at, self.utc_offset):
+            day = (t + offset) // 86400
+            date = dates.get(day)
+            if date is None:
+                date = dates[day] = period_start(datetime.date.fromordinal(day + _EPOCH_ORDINAL), period)
+            column.append(date)
+        return column
+
+    def _key_column(self, key):
+        """Return a list of keys per row, for a column name or tuple of names."""
+        if isinstance(key, str):
+            return self.column(key)
+        return list(zip(*[self.column(k) for k in key]))
+
+    # Masks
+
+    def mask_eq(self, name, value):
+        """Return a mask of the rows where column name equals value."""
+        return bytearray([x == value for x in self.column(name)])
+
+    def mask_in(self, name, values):
+        """Return a mask of the rows where column name is one of values."""
+        values = set(values)
+        return bytearray([x in values for x in self.column(name)])
+
+    def mask_range(self, name, low, high):
+        """Return a mask of the rows where low <= column name <= high."""
+        return bytearray([low <= x <= high for x in self.column(name)])
+
+    @staticmethod
+    def mask_and(a, b):
+        return bytearray([x & y for (x, y) in zip(a, b)])
+
+    @staticmethod
+    def mask_or(a, b):
+        return bytearray([x | y for (x, y) in zip(a, b)])
+
+    @staticmethod
+    def mask_not(a):
+        return a.translate(bytes([1, 0]) + bytes(254))
+
+    # Selection and ordering
+
+    def take(self, indices):
+        """Return a new EntryTable containing the rows at indices, in that order."""
+        table = EntryTable(self.md)
+        for name in self.INT_COLUMNS:
+            column = getattr(self, name)
+            setattr(table, name, array.array('q', [column[i] for i in indices]))
+        timer_active = self.timer_active
+        table.timer_active = bytearray([timer_active[i] for i in indices])
+        description = self.description
+        table.description = array.array('l', [description[i] for i in indices])
+        # The string pool is shared; it is only ever appended to.
+        table.strings = self.strings
+        table._string_index = self._string_index
+        return table
+
+    def filter(self, mask):
+        """Return a new EntryTable with the rows where mask is set."""
+        return self.take([i for (i, m) in enumerate(mask) if m])
+
+    def argsort(self, *names):
+        """Return the row indices ordered by the given columns."""
+        if len(names) == 1:
+            column = self.column(names[0])
+            return sorted(range(len(self)), key=column.__getitem__)
+        keys = self._key_column(names)
+        return sorted(range(len(self)), key=keys.__getitem__)
+
+    def sort(self, *names):
+        """Return a new EntryTable sorted by the given columns."""
+        return self.take(self.argsort(*names))
+
+    # Aggregation
+
+    def group_sum(self, key, value='duration'):
+        """Return a dictionary mapping each distinct key to the sum of the value
+        column over its rows. key is a column name or a tuple of names."""
+        totals = {}
+        get = totals.get
+        for (k, v) in zip(self._key_column(key), self.column(value)):
+            totals[k] = get(k, 0) + v
+        return totals
+
+    def group_count(self, key):
+        """Return a dictionary mapping each distinct key to its number of rows."""
+        counts = {}
+        get = counts.get
+        for k in self._key_column(key):
+            counts[k] = get(k, 0) + 1
+        return counts
+
+    # Conversion
+
+    def raw(self, i):
+        """Return the raw entry dictionary for row i."""
+        project_id = self.project_id[i]
+        offset = datetime.timezone(datetime.timedelta(seconds=self.utc_offset[i]))
+        date = datetime.datetime.fromtimestamp(self.logged_at[i], offset)
+        return {'id': self.entry_id[i], 'user_id': self.user_id[i], 'contact_id': self.contact_id[i],
+                'project_id': None if project_id == NO_PROJECT else project_id,
+                'duration': self.duration[i], 'description': self.strings[self.description[i]],
+                'timer_active': bool(self.timer_active[i]), 'logged_at': format_logged_at(date)}
+
+    def entry(self, i):
+        """Return an Entry object for row i."""
+        return Entry(self.md, self.raw(i))
+
+    def entries(self):
+        """Return a list of Entry objects for all rows."""
+        return [self.entry(i) for i in range(len(self))]
+
+    def to_numpy(self):
+        """Return a dictionary of NumPy arrays viewing the columns without
+        copying. Requires NumPy."""
+        import numpy
+        columns = dict([(name, numpy.frombuffer(getattr(self, name), dtype=numpy.int64))
+                        for name in self.INT_COLUMNS])
+        columns['timer_active'] = numpy.frombuffer(self.timer_active, dtype=numpy.bool_)
+        columns['description'] = numpy.frombuffer(self.description, dtype=numpy.dtype('l'))
+        return columns
@@ -4,20 +4,15 @@ a custom report.
 """
 import argparse
 import datetime
+import operator
 from md import MinuteDock
+from mdagg import aggregate, group_by
 
 def mysort(sortable, *attrs):
-    def mykey(x):
-        return tuple([getattr(x, attr) for attr in attrs])
-
-    sortable.sort(key=mykey)
+    sortable.sort(key=operator.attrgetter(*attrs))
 
 def mygroup(iterable, attr):
-    groups = {}
-    for i in iterable:
-        grouping = getattr(i, attr)
-        groups[grouping] = groups.get(grouping, []) + [i]
-    return groups.values()
+    return group_by(iterable, attr).values()
 
 def report(md):
     entries = md.entries_search(date_range = (datetime.date(2012, 7, 1), datetime.date(2012, 7, 31)),
@@ -31,17 +26,15 @@ def report(md):
     entries = [e for e in entries if not e.timer_active]
     mysort(entries, 'user_id', 'date')
     groups = mygroup(entries, 'user_id')
+    totals = aggregate(entries, 'user')
 
-    total_time = 0
     for g in groups:
         user = md.users_by_id[g[0].user_id]
         print("%s %s" % (user.first_name, user.last_name))
-        time = 0
         for e in g:
             print("%-20s %s %-5.2f %s" % (e.date.strftime("%d/%m/%Y"), e.project_id, e.duration / 3600.0, e.description))
-            time += e.duration
-        print("   SUB TIME", time/3600.0)
-        total_time += time
+        print("   SUB TIME", totals[user.user_id].total/3600.0)
+    total_time = sum([a.total for a in totals.values()])
     print("%-20s %-5.2f" % ("Total time", total_time / 3600.0))
 
 def main():
@@ -15,7 +15,10 @@ def update(md):
 
     for e in entries:
         e.change_project('new_project')
-        e.update()
+
+    for result in md.update_many(entries, workers=8):
+        if result.error is not None:
+            print("Failed to update entry %s: %s" % (result.entry.entry_id, result.error))
 
 def main():
     md = MinuteDock()